@@ -1,5 +1,9 @@
+import hashlib
+import hmac
+import time
 import requests
 from enum import Enum
+from urllib.parse import urlparse, parse_qsl, quote, unquote
 
 
 class Permission(Enum):
@@ -9,8 +13,36 @@ class Permission(Enum):
     AUTHENTICATED = 'authenticated'
 
 
+class OssAuth(requests.auth.AuthBase):
+    """
+    使用secret_key对请求方法、路径、查询参数与请求时间签名，secret_key不随请求发送
+    """
+
+    def __init__(self, access_key: str, secret_key: str):
+        self.ak = access_key
+        self.sk = secret_key
+
+    def __call__(self, r):
+        url = urlparse(r.url)
+        date = str(int(time.time()))
+        query = sorted(
+            (quote(k, safe='-_.~'), quote(v, safe='-_.~'))
+            for k, v in parse_qsl(url.query, keep_blank_values=True) if k != 'signature'
+        )
+        string_to_sign = '\n'.join((
+            'OSS-HMAC-SHA256',
+            date,
+            r.method.upper(),
+            quote(unquote(url.path), safe='/-_.~'),
+            '&'.join('%s=%s' % i for i in query)
+        ))
+        signature = hmac.new(self.sk.encode(), string_to_sign.encode(), hashlib.sha256).hexdigest()
+        r.headers['X-Oss-Date'] = date
+        r.headers['Authorization'] = 'OSS-HMAC-SHA256 Credential=%s, Signature=%s' % (self.ak, signature)
+        return r
+
+
 class Oss:
-    session = requests.session()
 
     def __init__(self, access_key: str, secret_key: str, server: str):
         self.ak = access_key
@@ -19,6 +51,8 @@ class Oss:
             exit('server address must be start with http:// or https://')
 
         self.server = server
+        self.session = requests.session()
+        self.session.auth = OssAuth(access_key, secret_key)
 
     def create_directory(self, bucket_name: str, folder_name: str, path_key_url=None):
         """
@@ -34,11 +68,7 @@ class Oss:
 
         rep = self.session.post(
             '%s/api/objects/create_folder' % self.server,
-            json=post_data,
-            params={
-                'access_key': self.ak,
-                'secret_key': self.sk
-            },
+            json=post_data
         )
         return rep.json()
 
@@ -46,34 +76,30 @@ class Oss:
         """
         上传对象至指定的桶，如果指定路径则上传文件至指定的目录下，不指定则上传至根目录
         不指定文件权限则上传文件的访问权限继续桶的访问权限
+        桶名、路径、权限通过查询字符串传递，服务端边接收边写入后端存储
         """
-        post_data = {
+        params = {
             'bucket_name': bucket_name
         }
 
         if perm:
-            post_data['permission'] = perm.value
+            params['permission'] = perm.value
 
         if path_key_url:
-            post_data['path'] = path_key_url
-
-        rep = self.session.put(
-            '%s/api/objects/upload_file' % self.server,
-            data=post_data,
-            files={
-                'file': open(file, 'rb')
-            },
-            params={
-                'access_key': self.ak,
-                'secret_key': self.sk
-            }
-        )
-        return rep.json
+            params['path'] = path_key_url
+
+        with open(file, 'rb') as fp:
+            rep = self.session.put(
+                '%s/api/objects/upload_file' % self.server,
+                files={
+                    'file': fp
+                },
+                params=params
+            )
+        return rep.json()
 
     def list_objects_by_bucket(self, bucket_name: str, path_key_url: str = None, page_size: int = 10, page: int = 1):
         params = {
-            'access_key': self.ak,
-            'secret_key': self.sk,
             'bucket_name': bucket_name,
             'path': path_key_url,
             'page': page,
@@ -89,8 +115,6 @@ class Oss:
         rep = self.session.delete(
             '%s/api/objects/delete' % self.server,
             params={
-                'access_key': self.ak,
-                'secret_key': self.sk,
                 'bucket_name': bucket_name,
                 'key': key_url
             }
@@ -103,10 +127,6 @@ class Oss:
             json={
                 'bucket_name': bucket_name,
                 'key': key_url
-            },
-            params={
-                'access_key': self.ak,
-                'secret_key': self.sk
             }
         )
         return rep.json()
@@ -115,8 +135,6 @@ class Oss:
         rep = self.session.get(
             '%s/api/objects/download_file' % self.server,
             params={
-                'access_key': self.ak,
-                'secret_key': self.sk,
                 'bucket_name': bucket_name,
                 'key': key_url
             }
@@ -131,8 +149,6 @@ class Oss:
         """
 
         params = {
-            'access_key': self.ak,
-            'secret_key': self.sk,
             'bucket_name': bucket_name,
             'key': key,
         }
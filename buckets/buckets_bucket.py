@@ -4,7 +4,7 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 from rest_framework.decorators import api_view
-from rest_framework.exceptions import ParseError, NotFound
+from rest_framework.exceptions import ParseError, NotFound, APIException
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 from rest_framework.status import HTTP_201_CREATED
@@ -15,6 +15,7 @@ from rgwadmin.exceptions import NoSuchKey, NoSuchBucket
 
 from buckets.models import BucketRegion, BucketAcl, Buckets
 from objects.models import Objects
+from objects.objects_usage import delete_bucket
 from buckets.serializer import BucketSerialize
 from common.func import validate_post_data, s3_client, rgw_client
 from common.tokenauth import verify_permission
@@ -159,8 +160,8 @@ class BucketEndpoint(APIView):
                 rgw.remove_bucket(bucket=bucket.name, purge_objects=True)
             if bucket.bucket_region.type == 'amazon':
                 self.delete_all_file_by_bucket(bucket)
-            # 删除数据记录
-            bucket.delete()
+            # 删除数据记录，同时扣除用户与区域的用量
+            delete_bucket(bucket)
         except NoSuchKey:
             # print(bucket.name)
             # rgw.remove_bucket(bucket=bucket.name)
@@ -169,6 +170,8 @@ class BucketEndpoint(APIView):
         except NoSuchBucket:
             raise ParseError('delete bucket failed, not found this bucket')
 
+        except APIException:
+            raise
         except Exception as e:
             raise ParseError(detail=str(e))
 
@@ -256,6 +259,8 @@ def get_bucket_detail_endpoint(request):
     try:
         rgw = rgw_client(b.bucket_region.reg_id)
         data = rgw.get_bucket(bucket=bucket_name)
+    except APIException:
+        raise
     except Exception as e:
         raise ParseError(detail=str(e))
 
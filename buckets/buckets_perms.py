@@ -1,6 +1,6 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from rest_framework.exceptions import ParseError, NotFound, NotAuthenticated
+from rest_framework.exceptions import ParseError, NotFound, NotAuthenticated, APIException
 
 from common.tokenauth import verify_permission
 from .models import Buckets
@@ -36,6 +36,8 @@ def set_bucket_perm_endpoint(request):
         # 更新本地数据库
         b.permission = data['permission']
         b.save()
+    except APIException:
+        raise
     except Exception as e:
         raise ParseError(detail=str(e))
 
@@ -1,10 +1,16 @@
+from django.core.cache import cache
+from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import DjangoModelPermissions
 
 from buckets.models import BucketRegion
-from common.func import validate_post_data
-from common.verify import verify_max_length, verify_pk, verify_in_array, verify_url
+from common.clients import invalidate_region_clients
+from common.breaker import get_breaker
+from common.func import validate_post_data, verify_super_user
+from user.user_sync import mark_users_unsync
+from objects.objects_usage import delete_region
+from common.verify import verify_max_length, verify_pk, verify_in_array, verify_url, verify_number_range
 
 import copy
 
@@ -20,11 +26,21 @@ class BucketRegionEndpoint(APIView):
         ('*access_key', str, (verify_max_length, 32)),
         ('*server', str, verify_url),
         ('*type', str, (verify_max_length, 10)),
-        ('*state', str, (verify_in_array, ('e', 'd', 's')))
+        ('*state', str, (verify_in_array, ('e', 'd', 's'))),
+        ('max_pool_connections', int, (verify_number_range, (0, 1001))),
+        ('connect_timeout', int, (verify_number_range, (0, 601))),
+        ('read_timeout', int, (verify_number_range, (0, 3601))),
+        ('retry_mode', str, (verify_in_array, ('legacy', 'standard', 'adaptive'))),
+        ('max_attempts', int, (verify_number_range, (0, 21))),
+        # s3的分段大小为5MB至5GB
+        ('multipart_threshold', int, (verify_number_range, (5 * 1024 ** 2 - 1, 5 * 1024 ** 3 + 1))),
+        ('multipart_chunksize', int, (verify_number_range, (5 * 1024 ** 2 - 1, 5 * 1024 ** 3 + 1))),
     ]
     pk_field = (
         ('*reg_id', int, (verify_pk, model)),
     )
+    # 修改后需要在区域中重新同步用户的字段
+    sync_fields = ('server', 'access_key', 'secret_key', 'type', 'state')
 
     def get(self, request):
         req_user = request.user
@@ -38,6 +54,8 @@ class BucketRegionEndpoint(APIView):
     def post(self, request):
         data = validate_post_data(request.body, tuple(self.fields))
         self.queryset, create = self.model.objects.update_or_create(**data)
+        # 在新的区域中创建所有用户
+        mark_users_unsync()
         return Response({
             'code': 0,
             'msg': 'success',
@@ -49,7 +67,13 @@ class BucketRegionEndpoint(APIView):
         fields.append(self.pk_field[0])
         data = validate_post_data(request.body, tuple(fields))
         self.queryset = self.model.objects.filter(pk=data['reg_id'])
+        old = self.queryset.values(*self.sync_fields).first()
         self.queryset.update(**data)
+        # update不会触发post_save信号，需要手动使该区域的客户端失效
+        invalidate_region_clients(data['reg_id'])
+        # 只有区域的地址、密钥或状态改变时才需要重新同步用户，修改超时等客户端参数不触发全量同步
+        if old and any(old[i] != data[i] for i in self.sync_fields):
+            mark_users_unsync()
         return Response({
             'code': 0,
             'msg': 'success'
@@ -57,7 +81,9 @@ class BucketRegionEndpoint(APIView):
 
     def delete(self, request):
         data = validate_post_data(request.body, self.pk_field)
-        self.model.objects.get(pk=data['reg_id']).delete()
+        # 区域中的桶与文件对象通过用量账本删除，保持用户与桶的用量一致
+        delete_region(self.model.objects.get(pk=data['reg_id']))
+        invalidate_region_clients(data['reg_id'])
         return Response({
             'code': 0,
             'msg': 'success'
@@ -70,3 +96,26 @@ class BucketRegionEndpoint(APIView):
     #     if 'http://' in url:
     #         return url[7:]
     #     return url
+
+
+@api_view(('GET',))
+def query_region_health_endpoint(request):
+    """
+    查询各区域的熔断器状态，包括当前进程的状态与最近写入缓存的其它进程的状态
+    """
+    verify_super_user(request)
+    regions = BucketRegion.objects.all()
+    published = cache.get_many(['region_health_%s' % i.reg_id for i in regions])
+    data = []
+    for i in regions:
+        data.append({
+            'reg_id': i.reg_id,
+            'name': i.name,
+            'local': get_breaker(i.reg_id).json,
+            'published': published.get('region_health_%s' % i.reg_id, None),
+        })
+    return Response({
+        'code': 0,
+        'msg': 'success',
+        'data': data
+    })
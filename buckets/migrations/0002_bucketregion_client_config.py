@@ -0,0 +1,48 @@
+# Generated by Django 3.2.6 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buckets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bucketregion',
+            name='connect_timeout',
+            field=models.IntegerField(default=60, verbose_name='connect timeout'),
+        ),
+        migrations.AddField(
+            model_name='bucketregion',
+            name='max_attempts',
+            field=models.IntegerField(default=3, verbose_name='retry max attempts'),
+        ),
+        migrations.AddField(
+            model_name='bucketregion',
+            name='max_pool_connections',
+            field=models.IntegerField(default=10, verbose_name='max pool connections'),
+        ),
+        migrations.AddField(
+            model_name='bucketregion',
+            name='multipart_chunksize',
+            field=models.BigIntegerField(default=5242880, verbose_name='multipart chunk size'),
+        ),
+        migrations.AddField(
+            model_name='bucketregion',
+            name='multipart_threshold',
+            field=models.BigIntegerField(default=8388608, verbose_name='multipart threshold'),
+        ),
+        migrations.AddField(
+            model_name='bucketregion',
+            name='read_timeout',
+            field=models.IntegerField(default=60, verbose_name='read timeout'),
+        ),
+        migrations.AddField(
+            model_name='bucketregion',
+            name='retry_mode',
+            field=models.CharField(choices=[('legacy', 'legacy'), ('standard', 'standard'), ('adaptive', 'adaptive')], default='standard', max_length=10, verbose_name='retry mode'),
+        ),
+    ]
@@ -1,3 +1,4 @@
+from botocore.config import Config
 from django.db import models
 from django.contrib.auth.models import User
 import random
@@ -9,6 +10,11 @@ class BucketRegion(models.Model):
         ('e', 'enable'),
         ('d', 'disable'),
     )
+    RETRY_MODE = (
+        ('legacy', 'legacy'),
+        ('standard', 'standard'),
+        ('adaptive', 'adaptive'),
+    )
     reg_id = models.AutoField(primary_key=True, auto_created=True)
     name = models.CharField(max_length=100, verbose_name='name', blank=False, null=False)
     secret_key = models.CharField(verbose_name='secret key', max_length=50)
@@ -16,11 +22,31 @@ class BucketRegion(models.Model):
     server = models.CharField(verbose_name='server ip', max_length=20)
     type = models.CharField(verbose_name='region type', max_length=20, default='local')
     state = models.CharField(verbose_name='region state', max_length=1, default='e', choices=STATE)
+    # 该区域的s3客户端的连接池、超时、重试与分段上传设置
+    max_pool_connections = models.IntegerField(verbose_name='max pool connections', default=10)
+    connect_timeout = models.IntegerField(verbose_name='connect timeout', default=60)
+    read_timeout = models.IntegerField(verbose_name='read timeout', default=60)
+    retry_mode = models.CharField(verbose_name='retry mode', max_length=10, default='standard', choices=RETRY_MODE)
+    max_attempts = models.IntegerField(verbose_name='retry max attempts', default=3)
+    multipart_threshold = models.BigIntegerField(verbose_name='multipart threshold', default=8 * 1024 ** 2)
+    multipart_chunksize = models.BigIntegerField(verbose_name='multipart chunk size', default=5 * 1024 ** 2)
     create_time = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name, self.server
 
+    @property
+    def client_config(self) -> Config:
+        return Config(
+            max_pool_connections=self.max_pool_connections,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+            retries={
+                'mode': self.retry_mode,
+                'max_attempts': self.max_attempts,
+            }
+        )
+
     @property
     def json(self):
         return {
@@ -31,6 +57,13 @@ class BucketRegion(models.Model):
             'server': self.server,
             'type': self.type,
             'state': self.state,
+            'max_pool_connections': self.max_pool_connections,
+            'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout,
+            'retry_mode': self.retry_mode,
+            'max_attempts': self.max_attempts,
+            'multipart_threshold': self.multipart_threshold,
+            'multipart_chunksize': self.multipart_chunksize,
         }
 
 
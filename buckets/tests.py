@@ -1,3 +1,51 @@
-from django.test import TestCase
+import json
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from buckets import buckets_region
+from buckets.buckets_region import BucketRegionEndpoint
+from buckets.models import BucketRegion
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BucketRegionEndpointTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create(username='region_admin', is_superuser=True)
+        self.region = BucketRegion.objects.create(
+            name='test', server='http://127.0.0.1', access_key='AK', secret_key='SK', type='ceph', state='e'
+        )
+        patcher = mock.patch.object(buckets_region, 'mark_users_unsync')
+        self.mark_users_unsync = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def put(self, **kwargs):
+        data = {
+            'reg_id': self.region.reg_id, 'name': 'test', 'server': 'http://127.0.0.1',
+            'access_key': 'AK', 'secret_key': 'SK', 'type': 'ceph', 'state': 'e',
+        }
+        data.update(kwargs)
+        request = APIRequestFactory().put('/api/buckets/region', json.dumps(data), content_type='application/json')
+        force_authenticate(request, self.admin)
+        return BucketRegionEndpoint.as_view()(request)
+
+    def test_client_settings_changed(self):
+        # 修改客户端参数不需要重新同步用户
+        self.assertEqual(self.put(name='renamed', read_timeout=120).status_code, 200)
+        self.assertEqual(BucketRegion.objects.get(pk=self.region.reg_id).read_timeout, 120)
+        self.mark_users_unsync.assert_not_called()
+
+    def test_credentials_changed(self):
+        self.assertEqual(self.put(secret_key='SK2').status_code, 200)
+        self.mark_users_unsync.assert_called_once_with()
+
+    def test_server_changed(self):
+        self.assertEqual(self.put(server='http://127.0.0.2').status_code, 200)
+        self.mark_users_unsync.assert_called_once_with()
@@ -0,0 +1,128 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from buckets.models import BucketAcl
+from objects.models import ObjectAcl
+
+
+class AclIndex:
+    """
+    桶与文件对象的授权用户索引
+
+    每个桶、文件对象的索引为(拥有读权限的用户id集合, 拥有读写权限的用户id集合)，
+    进程内缓存ACL_LOCAL_TTL秒，memcached中缓存ACL_CACHE_TIME秒，授权修改时删除
+    """
+
+    def __init__(self):
+        self._items = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(kind: str, pk: int) -> str:
+        return 'acl_%s_%s' % (kind, pk)
+
+    def get_many(self, keys: list) -> dict:
+        """
+        keys为(类型, 主键)的列表，类型为b(桶)或者o(文件对象)，返回{(类型, 主键): 索引}
+        """
+        result = dict()
+        missing = []
+        now = time.monotonic()
+        for k in keys:
+            item = self._items.get(k, None)
+            if item and item[1] > now:
+                result[k] = item[0]
+            else:
+                missing.append(k)
+        if not missing:
+            return result
+
+        try:
+            cached = cache.get_many([self.cache_key(*k) for k in missing])
+        except Exception as e:
+            settings.LOGGER.error('get acl index failed: %s' % e)
+            cached = dict()
+
+        for k in missing:
+            index = cached.get(self.cache_key(*k), None)
+            remote = index is None
+            if remote:
+                index = self.load(*k)
+            self.set(k, index, remote)
+            result[k] = index
+        return result
+
+    @staticmethod
+    def load(kind: str, pk: int) -> tuple:
+        if kind == 'b':
+            rows = BucketAcl.objects.filter(bucket_id=pk).values_list('user_id', 'permission')
+        else:
+            rows = ObjectAcl.objects.filter(object_id=pk).values_list('user_id', 'permission')
+        read = set()
+        read_write = set()
+        for user_id, permission in rows:
+            # authenticated-read-write同时拥有读权限
+            if permission.startswith('authenticated-read'):
+                read.add(user_id)
+            if permission.startswith('authenticated-read-write'):
+                read_write.add(user_id)
+        return frozenset(read), frozenset(read_write)
+
+    def set(self, key: tuple, index: tuple, remote: bool = True):
+        with self._lock:
+            self._items[key] = (index, time.monotonic() + settings.ACL_LOCAL_TTL)
+            if len(self._items) > 10000:
+                self._items.clear()
+        if remote:
+            try:
+                cache.set(self.cache_key(*key), index, settings.ACL_CACHE_TIME)
+            except Exception as e:
+                settings.LOGGER.error('set acl index failed: %s' % e)
+
+    def invalidate(self, kind: str, pk: int):
+        with self._lock:
+            self._items.pop((kind, pk), None)
+        try:
+            cache.delete(self.cache_key(kind, pk))
+        except Exception as e:
+            settings.LOGGER.error('invalidate acl index failed: %s' % e)
+
+
+ACL_INDEX = AclIndex()
+
+
+def get_authorized_users(perm_value: str, bucket_id: int, obj_id: int = None) -> frozenset:
+    """
+    获取桶(以及文件对象)授权的用户id集合，perm_value为read或者read-write
+    """
+    keys = [('b', bucket_id)]
+    if obj_id:
+        keys.append(('o', obj_id))
+    n = 0 if perm_value == 'read' else 1
+    result = frozenset()
+    for index in ACL_INDEX.get_many(keys).values():
+        result = result | index[n]
+    return result
+
+
+def invalidate_bucket_acl(bucket_id: int):
+    ACL_INDEX.invalidate('b', bucket_id)
+
+
+def invalidate_object_acl(obj_id: int):
+    ACL_INDEX.invalidate('o', obj_id)
+
+
+@receiver([post_save, post_delete], sender=BucketAcl)
+def handle_bucket_acl_change(sender, instance, **kwargs):
+    invalidate_bucket_acl(instance.bucket_id)
+
+
+@receiver([post_save, post_delete], sender=ObjectAcl)
+def handle_object_acl_change(sender, instance, **kwargs):
+    invalidate_object_acl(instance.object_id)
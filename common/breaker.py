@@ -0,0 +1,188 @@
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, ReadTimeoutError
+from django.conf import settings
+from django.core.cache import cache
+from requests.exceptions import ConnectionError, Timeout
+from rest_framework.exceptions import APIException
+from rgwadmin.exceptions import ServerDown
+
+from common.metrics import METRICS_REGISTRY, metric_labels
+
+
+class RegionUnavailable(APIException):
+    status_code = 503
+    default_detail = 'storage region is unavailable, please try again later'
+    default_code = 'region_unavailable'
+
+
+class CircuitBreaker:
+    """
+    区域熔断器
+
+    记录每个区域后端调用的耗时与失败率(指数加权移动平均)，失败率超过阈值时熔断，
+    熔断期间的请求直接失败，熔断一段时间后半开，只放行一个探测请求，探测成功则恢复
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, reg_id: int):
+        self.reg_id = reg_id
+        self.state = self.CLOSED
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.opened_at = 0
+        self._probing = False
+        self._probe_started = 0
+        self._published_at = 0
+        self._lock = threading.Lock()
+
+    def check(self):
+        """
+        区域已熔断且未到半开时间时抛出RegionUnavailable，不占用半开的探测请求
+        """
+        if self.state == self.OPEN and time.time() - self.opened_at < settings.BREAKER_RESET_TIMEOUT:
+            raise RegionUnavailable()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < settings.BREAKER_RESET_TIMEOUT:
+                    raise RegionUnavailable()
+                self.state = self.HALF_OPEN
+                self._probing = False
+
+            if self.state == self.HALF_OPEN:
+                # 半开时只允许一个探测请求，探测请求长时间没有结果时允许重新探测
+                if self._probing and time.time() - self._probe_started < settings.BREAKER_RESET_TIMEOUT:
+                    raise RegionUnavailable()
+                self._probing = True
+                self._probe_started = time.time()
+
+    def record(self, latency: float, ok: bool):
+        alpha = settings.BREAKER_EWMA_ALPHA
+        with self._lock:
+            self.calls += 1
+            if not ok:
+                self.failures += 1
+            self.latency = latency if self.calls == 1 else alpha * latency + (1 - alpha) * self.latency
+            self.error_rate = alpha * (0 if ok else 1) + (1 - alpha) * self.error_rate
+
+            changed = False
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self.state = self.CLOSED
+                    self.error_rate = 0.0
+                else:
+                    self.state = self.OPEN
+                    self.opened_at = time.time()
+                changed = True
+            elif self.state == self.CLOSED and not ok and self.calls >= settings.BREAKER_MIN_CALLS and \
+                    self.error_rate >= settings.BREAKER_ERROR_RATE:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                changed = True
+
+        if changed:
+            settings.LOGGER.error('region %s circuit breaker %s, error rate: %.2f, latency: %.3fs' % (
+                self.reg_id, self.state, self.error_rate, self.latency
+            ))
+        self.publish(changed)
+
+    def publish(self, force: bool = False):
+        """
+        将本进程的区域状态写入缓存，供管理员查询
+        """
+        if not force and time.time() - self._published_at < 5:
+            return
+        self._published_at = time.time()
+        try:
+            cache.set('region_health_%s' % self.reg_id, self.json, 3600)
+        except Exception as e:
+            settings.LOGGER.error('publish region health failed: %s' % e)
+
+    @property
+    def json(self):
+        return {
+            'reg_id': self.reg_id,
+            'state': self.state,
+            'latency': round(self.latency, 4),
+            'error_rate': round(self.error_rate, 4),
+            'calls': self.calls,
+            'failures': self.failures,
+            'opened_at': int(self.opened_at),
+            'updated_at': int(time.time()),
+        }
+
+
+_breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(reg_id: int) -> CircuitBreaker:
+    breaker = _breakers.get(reg_id, None)
+    if breaker:
+        return breaker
+    with _breakers_lock:
+        if reg_id not in _breakers:
+            _breakers[reg_id] = CircuitBreaker(reg_id)
+        return _breakers[reg_id]
+
+
+def is_backend_failure(e: Exception) -> bool:
+    """
+    只有连接失败、超时与后端5xx错误计入失败，对象不存在等4xx错误说明区域是可用的
+    """
+    if isinstance(e, (BotoConnectionError, ReadTimeoutError, ConnectionError, Timeout, ServerDown)):
+        return True
+    if isinstance(e, ClientError):
+        return e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    return False
+
+
+class InstrumentedClient:
+    """
+    后端客户端代理，所有的方法调用都经过区域熔断器，并记录耗时与结果
+
+    backend为s3或者rgw，用于按后端类型、操作与区域统计调用耗时
+    """
+    # 只在本地执行，不访问后端的方法
+    LOCAL_METHODS = (
+        'generate_presigned_url', 'generate_presigned_post', 'can_paginate', 'get_paginator', 'get_waiter'
+    )
+
+    def __init__(self, client, breaker: CircuitBreaker, backend: str = 's3'):
+        self._client = client
+        self._breaker = breaker
+        self._backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name.startswith('_') or name in self.LOCAL_METHODS:
+            return attr
+
+        breaker = self._breaker
+        labels = metric_labels(backend=self._backend, operation=name, region=breaker.reg_id)
+
+        def call(*args, **kwargs):
+            breaker.before_call()
+            ts = time.monotonic()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                latency = time.monotonic() - ts
+                breaker.record(latency, not is_backend_failure(e))
+                METRICS_REGISTRY.observe('oss_backend_call_duration_seconds', labels, latency)
+                METRICS_REGISTRY.inc('oss_backend_call_errors_total', labels)
+                raise
+            latency = time.monotonic() - ts
+            breaker.record(latency, True)
+            METRICS_REGISTRY.observe('oss_backend_call_duration_seconds', labels, latency)
+            return result
+
+        return call
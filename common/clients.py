@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class ClientRegistry:
+    """
+    进程内的客户端缓存，按最近最少使用淘汰，超过ttl的客户端重新创建
+
+    每个客户端记录创建时所依赖的版本号，版本号保存在memcached中，
+    用户的key、配额或者区域修改后增加版本号，所有进程中的旧客户端都会失效
+    """
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            item = self._items.get(key, None)
+            if not item:
+                return None
+            client, client_version, expire_time = item
+            if client_version != version or expire_time < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return client
+
+    def set(self, key, version, client):
+        with self._lock:
+            self._items[key] = (client, version, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+S3_CLIENTS = ClientRegistry(settings.S3_CLIENT_CACHE_SIZE, settings.S3_CLIENT_CACHE_TTL)
+# 每个区域一个rgw管理客户端，复用其中的http连接池
+RGW_CLIENTS = ClientRegistry(64, settings.S3_CLIENT_CACHE_TTL)
+
+
+def get_versions(*names) -> tuple:
+    """
+    一次从memcached中读取多个版本号，memcached不可用时返回None，此时不使用缓存的客户端
+    """
+    keys = ['client_version_%s' % i for i in names]
+    try:
+        values = cache.get_many(keys)
+    except Exception as e:
+        settings.LOGGER.error('get client version failed: %s' % e)
+        return None
+    return tuple(values.get(k, 0) for k in keys)
+
+
+def bump_version(name: str):
+    key = 'client_version_%s' % name
+    try:
+        cache.incr(key)
+    except ValueError:
+        # 版本号不存在或已被淘汰时，以当前时间作为初始值，避免与淘汰前的版本号重复
+        if not cache.add(key, int(time.time() * 1000), None):
+            cache.incr(key)
+    except Exception as e:
+        settings.LOGGER.error('bump client version failed: %s' % e)
+
+
+def s3_client_version(reg_id: int, username: str):
+    return get_versions('region_%s' % reg_id, 'user_%s' % username)
+
+
+def rgw_client_version(reg_id: int):
+    return get_versions('region_%s' % reg_id)
+
+
+def user_cache_version(user_id: int):
+    return get_versions('account_%s' % user_id)
+
+
+def invalidate_user_cache(user_id: int):
+    """
+    用户、用户资料、key、配额修改后调用，使所有进程中缓存的用户与token记录中的用户状态失效
+    """
+    bump_version('account_%s' % user_id)
+
+
+def invalidate_user_clients(username: str):
+    """
+    用户的key、配额或者资料修改后调用，使该用户在所有区域的客户端失效
+    """
+    bump_version('user_%s' % username)
+
+
+def invalidate_region_clients(reg_id: int):
+    """
+    区域修改或者删除后调用，使该区域的所有s3客户端与rgw管理客户端失效
+    """
+    bump_version('region_%s' % reg_id)
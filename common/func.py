@@ -6,13 +6,16 @@ from objects.models import Objects
 from buckets.models import BucketRegion
 from django.contrib.auth.models import User
 from django.conf import Settings
+from django.core.cache import cache
 from rgwadmin.exceptions import NoSuchUser
 from hashlib import md5
 import random
 import os
 # import uuid
 import requests
-from oss import get_clock
+from oss import CLOCK
+from common.breaker import InstrumentedClient, get_breaker
+from common.clients import S3_CLIENTS, RGW_CLIENTS, s3_client_version, rgw_client_version
 
 from oss import settings
 
@@ -56,6 +59,25 @@ def verify_path(path: str, bucket_name: str):
 
 
 def rgw_client(region_id: int):
+    """
+    获取rgw客户端
+
+    每个区域的客户端在进程内缓存，使用持久的http连接池，区域修改后重新初始化
+    """
+    version = rgw_client_version(region_id)
+    client = RGW_CLIENTS.get(region_id, version) if version else None
+    if client:
+        return client
+
+    client = build_rgw_client(region_id)
+    if client:
+        client = InstrumentedClient(client, get_breaker(region_id), 'rgw')
+    if client and version:
+        RGW_CLIENTS.set(region_id, version, client)
+    return client
+
+
+def build_rgw_client(region_id: int):
     """
     初始化rgw客户端
 
@@ -73,16 +95,38 @@ def rgw_client(region_id: int):
         secure=False if b.server.startswith('http://') else True,
         verify=False,
         timeout=5,
+        # 使用requests.Session保持连接，避免每次调用都重新建立tcp与tls连接
+        pool_connections=True,
     )
 
 
 def s3_client(reg_id: int, username: str):
+    """
+    获取s3客户端
+
+    优先使用进程内缓存的客户端，缓存中没有或者用户、区域已修改时重新初始化
+    客户端的调用经过区域熔断器，区域熔断时直接抛出RegionUnavailable
+    """
+    key = (reg_id, username)
+    version = s3_client_version(reg_id, username)
+    client = S3_CLIENTS.get(key, version) if version else None
+    if client:
+        return client
+
+    client = build_s3_client(reg_id, username)
+    if client:
+        client = InstrumentedClient(client, get_breaker(reg_id))
+    if client and version:
+        S3_CLIENTS.set(key, version, client)
+    return client
+
+
+def build_s3_client(reg_id: int, username: str):
     """
     初始化s3客户端
 
-    使用指定区域中的管理员key查询用户是否存在
-    如果用户存在则使用用户的key创建s3客户端
-    如果不存在则创建该用户，使用指定的key，然后再初始化s3客户端
+    ceph区域使用用户的key创建s3客户端，用户在ceph中的账号与配额由后台同步线程创建与同步
+    amazon区域使用区域的key创建s3客户端
     """
     region = BucketRegion.objects.get(reg_id=reg_id)
     u = User.objects.select_related('profile'). \
@@ -92,35 +136,12 @@ def s3_client(reg_id: int, username: str):
         return
 
     if region.type == 'local':
-        rgw = rgw_client(reg_id)
-
-        try:
-            ceph_user = rgw.get_user(uid=u.keys.ceph_uid)
-        except NoSuchUser:
-            ceph_user = rgw.create_user(
-                uid=u.keys.ceph_uid,
-                access_key=u.keys.ceph_access_key,
-                secret_key=u.keys.ceph_secret_key,
-                display_name=u.first_name,
-                max_buckets=200,
-                user_caps='buckets=read,write;user=read,write;usage=read'
-            )
-        except Exception as e:
-            msg = e.args[0]
-            settings.LOGGER.error(msg)
-            raise ParseError(msg)
-
-        assert ceph_user, ParseError("ceph create user failed")
-
-        user_quota = ceph_user['user_quota']
-        if user_quota['enabled'] is not True or user_quota['max_size_kb'] != u.capacity_quota.capacity*1024**2:
-            rgw.set_user_quota(
-                uid=u.keys.ceph_uid,
-                max_size_kb=u.capacity_quota.capacity*1024**2,
-                enabled=True,
-                quota_type='user'
-            )
-            u.capacity_quota.ceph_sync()
+        # 用户的ceph账号与配额由后台同步线程处理，等待同步的用户只在ceph中还没有账号时在此创建，失败不影响请求
+        if u.capacity_quota.sync:
+            try:
+                ensure_ceph_user(reg_id, u)
+            except Exception as e:
+                settings.LOGGER.error('create ceph user %s failed: %s' % (username, e))
 
         conn = Session(
             aws_access_key_id=u.keys.ceph_access_key,
@@ -130,7 +151,8 @@ def s3_client(reg_id: int, username: str):
         client = conn.client(
             service_name='s3',
             endpoint_url=region.server,
-            verify=False
+            verify=False,
+            config=region.client_config
         )
         return client
 
@@ -143,11 +165,71 @@ def s3_client(reg_id: int, username: str):
         client = conn.client(
             service_name='s3',
             endpoint_url=region.server,
-            verify=False
+            verify=False,
+            config=region.client_config
         )
         return client
 
 
+def _ceph_user_key(reg_id: int, version, ceph_uid: str) -> str:
+    return 'ceph_user_%s_%s_%s' % (reg_id, version, ceph_uid)
+
+
+def get_or_create_ceph_user(rgw: RGWAdmin, u: User) -> dict:
+    """
+    获取用户在ceph中的账号，不存在时创建
+    """
+    try:
+        ceph_user = rgw.get_user(uid=u.keys.ceph_uid)
+    except NoSuchUser:
+        ceph_user = rgw.create_user(
+            uid=u.keys.ceph_uid,
+            access_key=u.keys.ceph_access_key,
+            secret_key=u.keys.ceph_secret_key,
+            display_name=u.first_name,
+            max_buckets=200,
+            user_caps='buckets=read,write;user=read,write;usage=read'
+        )
+
+    if not ceph_user:
+        raise ParseError("ceph create user failed")
+    return ceph_user
+
+
+def ensure_ceph_user(reg_id: int, u: User):
+    """
+    确保用户在区域的ceph中已有账号，已确认存在的账号记录在缓存中，之后的请求不再访问rgw，配额仍由后台同步线程处理
+
+    缓存的key中包含区域的版本号，区域修改或删除后记录随之失效，账号在ceph中被删除时最多CEPH_USER_CACHE_TIME秒后重新创建
+    """
+    version = rgw_client_version(reg_id)
+    key = _ceph_user_key(reg_id, version[0], u.keys.ceph_uid) if version else None
+    if key and cache.get(key):
+        return
+    rgw = rgw_client(reg_id)
+    if not rgw:
+        return
+    get_or_create_ceph_user(rgw, u)
+    if key:
+        cache.set(key, 1, settings.CEPH_USER_CACHE_TIME)
+
+
+def provision_ceph_user(rgw: RGWAdmin, u: User):
+    """
+    在ceph中创建不存在的用户，并将用户配额同步为capacity_quota中的容量
+    """
+    ceph_user = get_or_create_ceph_user(rgw, u)
+
+    user_quota = ceph_user['user_quota']
+    if user_quota['enabled'] is not True or user_quota['max_size_kb'] != u.capacity_quota.capacity*1024**2:
+        rgw.set_user_quota(
+            uid=u.keys.ceph_uid,
+            max_size_kb=u.capacity_quota.capacity*1024**2,
+            enabled=True,
+            quota_type='user'
+        )
+
+
 def build_ceph_userinfo() -> tuple:
     """
     根据用户名构建ceph_uid, access_key, secret_key
@@ -221,7 +303,7 @@ def verify_super_user(request):
 
 
 def validate_license_expire():
-    # print(get_clock(), settings.LICENSE_INFO['end_time'])
-    c = get_clock()
+    # 从内存中的授权时钟读取，不读取检查点文件
+    c = CLOCK.now()
     if c <= 0 or c > settings.LICENSE_INFO['end_time']:
         raise ParseError('license is expired!')
\ No newline at end of file
@@ -0,0 +1,88 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# 进程内的理论到达时间，用于本地限速器以及memcached不可用时的降级
+_local_tat = {}
+_local_lock = threading.Lock()
+
+
+class BandwidthLimiter:
+    """
+    按用户共享的带宽限速器
+
+    使用GCRA算法实现令牌桶，缓存中只保存一个理论到达时间(微秒)，
+    所有进程的下载流通过原子的incr预约各自数据块的发送时间，令牌按时间平滑补充
+    """
+
+    def __init__(self, key: str, bandwidth: int):
+        self.key = 'bandwidth_limit_%s' % key
+        # bandwidth单位为MB/s
+        self.rate = bandwidth * 1024 ** 2
+        self.burst = int(settings.BANDWIDTH_LIMIT_BURST * 1000000)
+
+    def consume(self, size: int):
+        """
+        消耗size个字节的令牌，令牌不足时阻塞到该数据块允许发送的时间
+        """
+        if self.rate <= 0 or size <= 0:
+            return
+
+        cost = int(size * 1000000 / self.rate)
+        now = int(time.time() * 1000000)
+        try:
+            tat = self._reserve(cost, now)
+        except Exception as e:
+            # memcached不可用时降级为进程内限速，不影响下载
+            settings.LOGGER.error('bandwidth limiter error: %s' % e)
+            tat = self._local_reserve(cost, now)
+        # 数据块允许发送的时间为预约前的理论到达时间减去允许的突发时间
+        wait = (tat - cost - self.burst - now) / 1000000
+        if wait > 0:
+            time.sleep(wait)
+
+    def _reserve(self, cost: int, now: int) -> int:
+        try:
+            tat = cache.incr(self.key, cost)
+        except ValueError:
+            # 键不存在或已过期，从当前时间开始计算
+            cache.add(self.key, now, 3600)
+            tat = cache.incr(self.key, cost)
+
+        # 长时间空闲的令牌桶，理论到达时间落后于当前时间，重置为当前时间，空闲期间不累积令牌
+        if tat - cost < now - self.burst:
+            tat = now + cost
+            cache.set(self.key, tat, 3600)
+        return tat
+
+    def _local_reserve(self, cost: int, now: int) -> int:
+        with _local_lock:
+            tat = _local_tat.get(self.key, now)
+            if tat < now - self.burst:
+                tat = now
+            tat += cost
+            _local_tat[self.key] = tat
+        return tat
+
+
+class LocalBandwidthLimiter(BandwidthLimiter):
+    """
+    进程内的带宽限速器，不依赖memcached，用于测试与单进程部署
+    """
+
+    def _reserve(self, cost: int, now: int) -> int:
+        return self._local_reserve(cost, now)
+
+
+def get_bandwidth_limiter(key, bandwidth: int) -> BandwidthLimiter:
+    """
+    根据配置获取带宽限速器，key为用户id或者匿名用户的ip地址，
+    带宽达到UNSHAPED_BANDWIDTH的用户返回不限速的限速器(rate为0)
+    """
+    if settings.UNSHAPED_BANDWIDTH and bandwidth >= settings.UNSHAPED_BANDWIDTH:
+        bandwidth = 0
+    if settings.BANDWIDTH_LIMITER == 'local':
+        return LocalBandwidthLimiter(key, bandwidth)
+    return BandwidthLimiter(key, bandwidth)
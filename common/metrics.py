@@ -0,0 +1,236 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# 指标名称: (类型, 说明, 直方图分桶)
+METRICS = {
+    'oss_http_requests_total': ('counter', 'Total http requests by view, method and status.', None),
+    'oss_http_request_duration_seconds': ('histogram', 'Http request latency by view and method.', LATENCY_BUCKETS),
+    'oss_http_requests_in_flight': ('gauge', 'Http requests currently being processed.', None),
+    'oss_db_queries_per_request': ('histogram', 'Database queries executed per http request.', QUERY_BUCKETS),
+    'oss_db_query_duration_seconds': ('histogram', 'Database query latency.', LATENCY_BUCKETS),
+    'oss_backend_call_duration_seconds': (
+        'histogram', 'Ceph backend call latency by backend, operation and region.', LATENCY_BUCKETS
+    ),
+    'oss_backend_call_errors_total': ('counter', 'Failed ceph backend calls by backend, operation and region.', None),
+    'oss_download_bytes_total': ('counter', 'Bytes streamed from ceph to download clients by region.', None),
+    'oss_download_redirects_total': ('counter', 'Downloads redirected to presigned backend urls by region.', None),
+    'oss_download_redirect_bytes_total': (
+        'counter', 'Object bytes of downloads redirected to presigned backend urls by region.', None
+    ),
+    'oss_download_prefetch_streams_total': ('counter', 'Downloads streamed through the prefetch pipeline.', None),
+    'oss_download_prefetch_backend_stall_seconds_total': (
+        'counter', 'Seconds download iterators waited for data from ceph.', None
+    ),
+    'oss_download_prefetch_client_stall_seconds_total': (
+        'counter', 'Seconds prefetch threads waited for download clients to consume data.', None
+    ),
+}
+
+
+class Metrics:
+    """
+    进程内的指标
+
+    请求线程只在内存中累加，由每个进程中的后台线程每隔METRICS_DUMP_INTERVAL秒将指标写入
+    METRICS_DIR目录中以进程id与进程启动时间命名的文件，查询时合并所有存活进程的文件，uwsgi的多个worker共享同一份结果
+    """
+
+    def __init__(self):
+        self.values = dict()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._filename = None
+
+    def inc(self, name: str, labels: tuple = (), value=1):
+        self._ensure_started()
+        key = (name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        self._ensure_started()
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            item = self.values.get(key, None)
+            if item is None:
+                # 各分桶的计数(最后一个为+Inf)、总和、总数
+                item = self.values[key] = [0] * (len(buckets) + 3)
+            item[bisect_left(buckets, value)] += 1
+            item[-2] += value
+            item[-1] += 1
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # fork之后不继承父进程的指标
+            self.values.clear()
+            self._pid = os.getpid()
+            self._filename = metrics_filename(self._pid)
+        if not settings.METRICS_DIR:
+            return
+        t = threading.Thread(target=self._run, args=())
+        t.setDaemon(True)
+        t.start()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.METRICS_DUMP_INTERVAL)
+            try:
+                self.dump()
+            except Exception as e:
+                settings.LOGGER.error('dump metrics failed: %s' % e)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[name, labels, value] for (name, labels), value in self.values.items()]
+
+    def dump(self):
+        """
+        原子地写入当前进程的指标文件
+        """
+        if not settings.METRICS_DIR:
+            return
+        self._ensure_started()
+        data = self.snapshot()
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        path = os.path.join(settings.METRICS_DIR, self._filename)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(data, fp)
+        os.replace(path + '.tmp', path)
+
+
+METRICS_REGISTRY = Metrics()
+
+
+def metric_labels(**kwargs) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+
+def process_start_time(pid: int):
+    """
+    进程的启动时间(系统启动后的时钟周期数)，用于区分重复使用的进程id，进程不存在时返回None
+    """
+    try:
+        with open('/proc/%s/stat' % pid) as fp:
+            # 进程名可能包含空格，从最后一个括号之后开始计算字段
+            return int(fp.read().rpartition(')')[2].split()[19])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, IndexError):
+        pass
+    # 没有/proc的系统只判断进程是否存在
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return 0
+
+
+def metrics_filename(pid: int) -> str:
+    return '%s-%s.json' % (pid, process_start_time(pid) or 0)
+
+
+def collect() -> dict:
+    """
+    合并所有存活进程的指标，已退出的进程的文件在合并时删除
+
+    文件名中的进程id与启动时间都与当前进程一致时才认为进程存活，进程id被重复使用时旧的文件也会被删除，
+    worker重启后计数器从0开始，prometheus按计数器重置处理
+    """
+    result = dict()
+    if not settings.METRICS_DIR:
+        # 没有配置指标目录时只输出当前进程的指标
+        sources = [METRICS_REGISTRY.snapshot()]
+    else:
+        METRICS_REGISTRY.dump()
+        sources = []
+        for f in os.scandir(settings.METRICS_DIR):
+            if not f.name.endswith('.json'):
+                continue
+            try:
+                pid = int(f.name[:-5].partition('-')[0])
+                if f.name != metrics_filename(pid):
+                    os.remove(f.path)
+                    continue
+                with open(f.path) as fp:
+                    sources.append(json.load(fp))
+            except (OSError, ValueError):
+                continue
+
+    for data in sources:
+        for name, label_list, value in data:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(tuple(i) for i in label_list))
+            old = result.get(key, None)
+            if old is None:
+                result[key] = value
+            elif isinstance(value, list):
+                result[key] = [a + b for a, b in zip(old, value)]
+            else:
+                result[key] = old + value
+    return result
+
+
+def format_labels(label_list, extra: tuple = ()) -> str:
+    items = tuple(label_list) + extra
+    if not items:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items
+    )
+
+
+def render() -> str:
+    """
+    按prometheus文本格式输出所有进程合并后的指标
+    """
+    values = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (n, label_list), value in sorted(values.items()):
+            if n != name:
+                continue
+            if kind != 'histogram':
+                lines.append('%s%s %s' % (name, format_labels(label_list), value))
+                continue
+            total = 0
+            for le, count in zip(tuple(buckets) + ('+Inf',), value):
+                total += count
+                lines.append('%s_bucket%s %s' % (name, format_labels(label_list, (('le', str(le)),)), total))
+            lines.append('%s_sum%s %s' % (name, format_labels(label_list), value[-2]))
+            lines.append('%s_count%s %s' % (name, format_labels(label_list), value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+class QueryCounter:
+    """
+    通过connection.execute_wrapper统计一个请求中执行的数据库查询
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        ts = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            METRICS_REGISTRY.observe('oss_db_query_duration_seconds', (), time.monotonic() - ts)
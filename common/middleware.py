@@ -1,8 +1,14 @@
 from django.contrib.auth.models import AnonymousUser
+from django.http.request import RawPostDataException
 from django.utils.deprecation import MiddlewareMixin
 import json
+import re
+import time
+from django.db import connection
 from .func import get_client_ip
 from django.conf import settings
+from oss import LazyJson
+from .metrics import METRICS_REGISTRY, QueryCounter, metric_labels
 
 
 class RequestLogMiddleware(MiddlewareMixin):
@@ -22,30 +28,35 @@ class RequestLogMiddleware(MiddlewareMixin):
             if request.content_type == 'multipart/form-data':
                 body = request.POST.dict()
                 file = request.FILES.get('file', None)
-                print(file)
                 body['file'] = str(file)
+            elif int(request.META.get('CONTENT_LENGTH') or 0) > 2*1024**2:
+                # 对象上传等大请求体不记录，避免将整个请求体读入内存
+                body = dict()
             else:
                 body = json.loads(request.body)
-        except json.decoder.JSONDecodeError:
+        except (json.decoder.JSONDecodeError, RawPostDataException, ValueError):
+            # 请求体已经以流的形式读取过的，无法再记录
             body = dict()
         body = self.filter_secure_data(body, ('password', 'pwd1', 'pwd2', 'old_pwd'))
 
-        query_string = request.META['QUERY_STRING']
+        # 查询字符串中的secret_key与签名不记录到日志
+        query_string = re.sub(r'(secret_key|signature)=[^&]*', r'\1=******', request.META['QUERY_STRING'])
         if query_string:
             url = request.path+'?'+query_string
         else:
             url = request.path
         msg = {
-            'body': None if not body else json.dumps(body, ensure_ascii=False).replace('"', '\''),
+            'body': body or None,
             'url': url,
             'method': request.method,
             'user': request.user.username if not isinstance(request.user, AnonymousUser) else 'AnonymousUser',
             'source_ip': get_client_ip(request),
             # 'destination_ip': socket.gethostbyname(socket.gethostname()),
             'response_status_code': response.status_code,
-            'content-length': len(response.content) if hasattr(response, 'content') else -1
+            # 从响应头中获取响应体大小，不读取响应体
+            'content-length': int(response['Content-Length']) if response.has_header('Content-Length') else -1
         }
-        self.logger.info(json.dumps(msg, ensure_ascii=False)[1:-1].replace('"', ''))
+        self.logger.info(LazyJson(msg))
 
         return response
 
@@ -55,3 +66,40 @@ class RequestLogMiddleware(MiddlewareMixin):
             if f in body:
                 body[f] = '******'
         return body
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    记录每个视图的请求数、耗时、数据库查询次数与正在处理的请求数
+
+    流式响应的耗时只统计到视图返回响应为止，传输的字节数在下载时单独统计
+    """
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        self.get_response = get_response
+
+    def __call__(self, request):
+        METRICS_REGISTRY.inc('oss_http_requests_in_flight')
+        counter = QueryCounter()
+        ts = time.monotonic()
+        try:
+            with connection.execute_wrapper(counter):
+                response = self.get_response(request)
+        finally:
+            METRICS_REGISTRY.inc('oss_http_requests_in_flight', value=-1)
+
+        # 使用url规则作为视图名称，避免路径中的参数产生大量的标签
+        match = getattr(request, 'resolver_match', None)
+        view = match.route if match else 'unmatched'
+        METRICS_REGISTRY.observe(
+            'oss_http_request_duration_seconds',
+            metric_labels(view=view, method=request.method),
+            time.monotonic() - ts
+        )
+        METRICS_REGISTRY.inc(
+            'oss_http_requests_total',
+            metric_labels(view=view, method=request.method, status=response.status_code)
+        )
+        METRICS_REGISTRY.observe('oss_db_queries_per_request', metric_labels(view=view), counter.count)
+        return response
@@ -0,0 +1,92 @@
+import hashlib
+import hmac
+import threading
+import time
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import cache
+
+SIGN_ALGORITHM = 'OSS-HMAC-SHA256'
+
+
+def canonical_query(params) -> str:
+    """
+    按参数名与参数值排序并编码查询参数，params为(参数名, 参数值)的列表，不包含signature参数
+    """
+    items = sorted(
+        (quote(k, safe='-_.~'), quote(v, safe='-_.~')) for k, v in params if k != 'signature'
+    )
+    return '&'.join('%s=%s' % i for i in items)
+
+
+def string_to_sign(method: str, path: str, params, date) -> str:
+    return '\n'.join((
+        SIGN_ALGORITHM,
+        str(date),
+        method.upper(),
+        quote(path, safe='/-_.~'),
+        canonical_query(params)
+    ))
+
+
+def sign(secret_key: str, method: str, path: str, params, date) -> str:
+    """
+    使用secret_key对请求方法、路径、查询参数与请求时间计算HMAC-SHA256签名
+    """
+    return hmac.new(
+        secret_key.encode(),
+        string_to_sign(method, path, params, date).encode(),
+        hashlib.sha256
+    ).hexdigest()
+
+
+class AccessKeyIndex:
+    """
+    access_key到(user_id, secret_key, allow_ip, is_active)的索引
+
+    进程内缓存ACCESS_KEY_LOCAL_TTL秒，memcached中缓存ACCESS_KEY_CACHE_TIME秒，
+    不存在的access_key缓存为False，避免重复查询数据库
+    """
+
+    def __init__(self):
+        self._items = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(access_key: str) -> str:
+        return 'access_key_%s' % access_key
+
+    def get_local(self, access_key: str):
+        item = self._items.get(access_key, None)
+        if not item or item[1] < time.monotonic():
+            return None
+        return item[0]
+
+    def set(self, access_key: str, info, remote: bool = True):
+        with self._lock:
+            self._items[access_key] = (info, time.monotonic() + settings.ACCESS_KEY_LOCAL_TTL)
+            if len(self._items) > 10000:
+                self._items.clear()
+        if remote:
+            cache.set(self.cache_key(access_key), info, settings.ACCESS_KEY_CACHE_TIME if info else 60)
+
+    def invalidate(self, access_key: str):
+        if not access_key:
+            return
+        with self._lock:
+            self._items.pop(access_key, None)
+        try:
+            cache.delete(self.cache_key(access_key))
+        except Exception as e:
+            settings.LOGGER.error('invalidate access key failed: %s' % e)
+
+
+ACCESS_KEYS = AccessKeyIndex()
+
+
+def invalidate_access_key(access_key: str):
+    """
+    修改用户的key、允许访问的ip或者用户状态后调用
+    """
+    ACCESS_KEYS.invalidate(access_key)
@@ -0,0 +1,312 @@
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from rest_framework import exceptions
+
+from buckets.models import BucketAcl, BucketRegion, Buckets
+from common import func, limiter, tokenauth
+from common.acl import ACL_INDEX, get_authorized_users
+from common.clients import S3_CLIENTS, invalidate_region_clients
+from common.limiter import BandwidthLimiter, LocalBandwidthLimiter
+from common.signature import SIGN_ALGORITHM, sign
+from common.tokenauth import TokenAuthentication, build_token_record
+from objects.models import ObjectAcl, Objects
+from user.models import CapacityQuota, Keys, Profile
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class FakeClock:
+    """
+    代替limiter模块中的time，sleep直接推进时间
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+@override_settings(CACHES=LOCMEM_CACHES, BANDWIDTH_LIMIT_BURST=0.5)
+class LocalBandwidthLimiterTest(SimpleTestCase):
+    limiter_class = LocalBandwidthLimiter
+
+    def setUp(self):
+        limiter._local_tat.clear()
+        self.clock = FakeClock()
+        patcher = mock.patch.object(limiter, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_throttle(self):
+        # 1MB/s的限速下载10MB，除去第一个数据块与允许的突发时间，需要等待8.5秒
+        lm = self.limiter_class('test', 1)
+        for _ in range(10):
+            lm.consume(1024 ** 2)
+        self.assertAlmostEqual(self.clock.slept, 8.5, places=3)
+
+    def test_shared_by_key(self):
+        a = self.limiter_class('shared', 1)
+        b = self.limiter_class('shared', 1)
+        for _ in range(5):
+            a.consume(1024 ** 2)
+            b.consume(1024 ** 2)
+        self.assertAlmostEqual(self.clock.slept, 8.5, places=3)
+
+    def test_idle_reset(self):
+        lm = self.limiter_class('idle', 1)
+        for _ in range(3):
+            lm.consume(1024 ** 2)
+        self.clock.now += 100
+        self.clock.slept = 0.0
+        # 空闲期间不累积令牌，只允许突发时间内的数据不等待
+        lm.consume(1024 ** 2)
+        self.assertEqual(self.clock.slept, 0)
+        lm.consume(1024 ** 2)
+        self.assertAlmostEqual(self.clock.slept, 0.5, places=3)
+
+    def test_unlimited(self):
+        lm = self.limiter_class('unlimited', 0)
+        for _ in range(10):
+            lm.consume(1024 ** 2)
+        self.assertEqual(self.clock.slept, 0)
+
+
+class BandwidthLimiterTest(LocalBandwidthLimiterTest):
+    limiter_class = BandwidthLimiter
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AuthTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        # 进程内缓存的用户与用户版本号不随测试数据库回滚
+        tokenauth.USERS.clear()
+        tokenauth._user_versions.clear()
+        self.user = User.objects.create(username='auth_test')
+        Keys.objects.filter(user=self.user).update(user_access_key='AK123', user_secret_key='SK456')
+        CapacityQuota.objects.filter(user=self.user).update(capacity=1, start_time=time.time(), duration=30)
+        self.factory = RequestFactory()
+
+
+class SignedRequestTest(AuthTestCase):
+
+    def signed_request(self, path: str, params: dict, date: int = None, signed_params: dict = None):
+        date = int(time.time()) if date is None else date
+        signature = sign('SK456', 'GET', path, list((signed_params or params).items()), date)
+        return self.factory.get(
+            path, params,
+            HTTP_AUTHORIZATION='%s Credential=AK123, Signature=%s' % (SIGN_ALGORITHM, signature),
+            HTTP_X_OSS_DATE=str(date)
+        )
+
+    def test_signed(self):
+        request = self.signed_request('/api/objects/list', {'bucket_name': 'test'})
+        user, _ = TokenAuthentication().authenticate(request)
+        self.assertEqual(user.pk, self.user.pk)
+
+    def test_params_changed(self):
+        request = self.signed_request(
+            '/api/objects/list', {'bucket_name': 'other'}, signed_params={'bucket_name': 'test'}
+        )
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            TokenAuthentication().authenticate(request)
+
+    def test_expired(self):
+        request = self.signed_request('/api/objects/list', {'bucket_name': 'test'}, date=int(time.time()) - 3600)
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            TokenAuthentication().authenticate(request)
+
+    def test_legacy_disabled(self):
+        # 默认不接受查询字符串中的secret_key
+        request = self.factory.get('/api/objects/list', {'access_key': 'AK123', 'secret_key': 'SK456'})
+        self.assertIsNone(TokenAuthentication().authenticate(request))
+
+    @override_settings(ALLOW_LEGACY_KEY_AUTH=True)
+    def test_legacy_enabled(self):
+        request = self.factory.get('/api/objects/list', {'access_key': 'AK123', 'secret_key': 'SK456'})
+        user, _ = TokenAuthentication().authenticate(request)
+        self.assertEqual(user.pk, self.user.pk)
+
+
+@override_settings(RATE_LIMIT_WINDOW=60, RATE_LIMIT_REQUESTS=3, RATE_LIMIT_BLOCK_TIMES=2, RATE_LIMIT_BLOCK_TIME=600)
+class RequestRateTest(AuthTestCase):
+
+    def request(self, ip: str = '10.0.0.1'):
+        return TokenAuthentication().authenticate(self.factory.get('/api/user/info', REMOTE_ADDR=ip))
+
+    def test_window_limit(self):
+        with mock.patch('common.tokenauth.time.time', return_value=6000):
+            for _ in range(3):
+                self.assertIsNone(self.request())
+            with self.assertRaises(exceptions.ParseError):
+                self.request()
+            # 其它ip不受影响
+            self.assertIsNone(self.request('10.0.0.2'))
+        # 新的窗口重新计数
+        with mock.patch('common.tokenauth.time.time', return_value=6060):
+            self.assertIsNone(self.request())
+
+    def test_block(self):
+        # 超过限制的窗口数达到RATE_LIMIT_BLOCK_TIMES后禁止访问
+        for window in (6000, 6060):
+            with mock.patch('common.tokenauth.time.time', return_value=window):
+                for _ in range(3):
+                    self.request()
+                with self.assertRaises(exceptions.ParseError):
+                    self.request()
+        with mock.patch('common.tokenauth.time.time', return_value=6120):
+            with self.assertRaisesMessage(exceptions.APIException, 'after 600 seconds'):
+                self.request()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AclIndexTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        ACL_INDEX._items.clear()
+        self.owner = User.objects.create(username='acl_owner')
+        Profile.objects.filter(user=self.owner).update(phone='1')
+        self.user = User.objects.create(username='acl_user')
+        region = BucketRegion.objects.create(name='test', server='http://127.0.0.1', type='local')
+        self.bucket = Buckets.objects.create(name='acl-test', user=self.owner, bucket_region=region)
+        self.obj = Objects.objects.create(bucket=self.bucket, name='a.txt', key='a.txt', type='f', owner=self.owner)
+
+    def test_cached(self):
+        get_authorized_users('read', self.bucket.bucket_id, self.obj.obj_id)
+        with self.assertNumQueries(0):
+            get_authorized_users('read', self.bucket.bucket_id, self.obj.obj_id)
+
+    def test_bucket_acl_change(self):
+        self.assertEqual(get_authorized_users('read', self.bucket.bucket_id), frozenset())
+        # 授权的保存与删除通过信号使索引失效
+        acl = BucketAcl.objects.create(bucket=self.bucket, user=self.user, permission='authenticated-read-write')
+        self.assertEqual(get_authorized_users('read', self.bucket.bucket_id), {self.user.id})
+        self.assertEqual(get_authorized_users('read-write', self.bucket.bucket_id), {self.user.id})
+        acl.delete()
+        self.assertEqual(get_authorized_users('read', self.bucket.bucket_id), frozenset())
+
+    def test_object_acl_change(self):
+        get_authorized_users('read', self.bucket.bucket_id, self.obj.obj_id)
+        ObjectAcl.objects.create(object=self.obj, user=self.user, permission='authenticated-read')
+        self.assertEqual(get_authorized_users('read', self.bucket.bucket_id, self.obj.obj_id), {self.user.id})
+        self.assertEqual(get_authorized_users('read-write', self.bucket.bucket_id, self.obj.obj_id), frozenset())
+
+
+@override_settings(USER_VERSION_TTL=0)
+class TokenRecordTest(AuthTestCase):
+
+    def request(self, ua: str = 'ua', ip: str = '127.0.0.1'):
+        return self.factory.get('/api/user/info', HTTP_USER_AGENT=ua, REMOTE_ADDR=ip, HTTP_AUTHORIZATION='Token abc')
+
+    def test_token(self):
+        cache.set('token_abc', build_token_record(self.user, 'ua', '127.0.0.1'))
+        user, _ = TokenAuthentication().authenticate(self.request())
+        self.assertEqual(user.pk, self.user.pk)
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            TokenAuthentication().authenticate(self.request(ua='other'))
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            TokenAuthentication().authenticate(self.request(ip='10.0.0.1'))
+
+    def test_user_changed(self):
+        # 用户被禁用后，token记录中的用户状态随用户版本号更新
+        cache.set('token_abc', build_token_record(self.user, 'ua', '127.0.0.1'))
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            TokenAuthentication().authenticate(self.request())
+
+    def test_old_format(self):
+        # 旧格式的记录(ua, ip, 最近访问时间, 用户)升级为新格式，已登陆的用户不需要重新登陆
+        user = User.objects.select_related('capacity_quota').get(pk=self.user.pk)
+        cache.set('token_abc', ('ua', '127.0.0.1', time.time(), user))
+        user, _ = TokenAuthentication().authenticate(self.request())
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(len(cache.get('token_abc')), 7)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class EnsureCephUserTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='ceph_test')
+        Keys.objects.filter(user=self.user).update(ceph_uid='ceph_test')
+        self.user = User.objects.select_related('keys').get(pk=self.user.pk)
+        patcher = mock.patch.object(func, 'rgw_client', return_value=object())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(func, 'get_or_create_ceph_user')
+        self.get_or_create = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cached(self):
+        func.ensure_ceph_user(1, self.user)
+        func.ensure_ceph_user(1, self.user)
+        self.assertEqual(self.get_or_create.call_count, 1)
+
+    def test_region_changed(self):
+        # 区域修改后重新确认用户在ceph中存在
+        func.ensure_ceph_user(1, self.user)
+        invalidate_region_clients(1)
+        func.ensure_ceph_user(1, self.user)
+        self.assertEqual(self.get_or_create.call_count, 2)
+
+    def test_ttl(self):
+        with mock.patch.object(func.cache, 'set') as cache_set:
+            func.ensure_ceph_user(1, self.user)
+        self.assertEqual(cache_set.call_args[0][2], func.settings.CEPH_USER_CACHE_TIME)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class S3ClientCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        S3_CLIENTS.clear()
+        self.user = User.objects.create(username='client_test')
+        patcher = mock.patch.object(func, 'build_s3_client', side_effect=lambda reg_id, username: object())
+        self.build = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cached(self):
+        client = func.s3_client(1, 'client_test')
+        self.assertIs(func.s3_client(1, 'client_test'), client)
+        self.assertIsNot(func.s3_client(2, 'client_test'), client)
+        self.assertEqual(self.build.call_count, 2)
+
+    def test_user_changed(self):
+        client = func.s3_client(1, 'client_test')
+        # 只修改同步标志时不重新创建客户端
+        self.user.capacity_quota.sync = 0
+        self.user.capacity_quota.save(update_fields=['sync'])
+        self.assertIs(func.s3_client(1, 'client_test'), client)
+        self.user.keys.save()
+        self.assertIsNot(func.s3_client(1, 'client_test'), client)
+
+    def test_region_changed(self):
+        client = func.s3_client(1, 'client_test')
+        invalidate_region_clients(1)
+        self.assertIsNot(func.s3_client(1, 'client_test'), client)
+
+    def test_cache_unavailable(self):
+        # memcached不可用时无法确认版本号，每次重新创建客户端
+        with mock.patch.object(func, 's3_client_version', return_value=None):
+            client = func.s3_client(1, 'client_test')
+            self.assertIsNot(func.s3_client(1, 'client_test'), client)
+        self.assertEqual(self.build.call_count, 2)
@@ -7,56 +7,63 @@ from rest_framework import exceptions, HTTP_HEADER_ENCODING
 from rest_framework.exceptions import NotAuthenticated, PermissionDenied
 from django.core.cache import cache
 from django.conf import settings
+from common.clients import ClientRegistry, user_cache_version
 from common.func import get_client_ip
+from common.signature import ACCESS_KEYS, SIGN_ALGORITHM, sign
 from django.urls import resolve
+import copy
+import hmac
 import time
+from hashlib import md5
 
 
 class TokenAuthentication(BaseAuthentication):
     def authenticate(self, request):
         client_ip = get_client_ip(request)
         block_key = 'block_ip_%s' % client_ip
+        # 黑名单与token记录在一次请求中读取
+        token = self.get_header_token(request)
+        keys = [block_key, 'token_%s' % token] if token else [block_key]
+
+        # 对外api使用access_key签名访问接口，access_key的索引也在同一次请求中读取
+        signed = self.get_signature_params(request) if request.path.startswith('/api/objects') else None
+        ak = signed[0] if signed else None
+        if not ak and request.path.startswith('/api/objects') and settings.ALLOW_LEGACY_KEY_AUTH:
+            ak = request.GET.get('access_key', None)
+        if ak and (not ak.isalnum() or len(ak) > 64):
+            ak = None
+        key_info = ACCESS_KEYS.get_local(ak) if ak else None
+        if ak and key_info is None:
+            keys.append(ACCESS_KEYS.cache_key(ak))
+
         try:
-            block_times = cache.get(block_key)
+            values = cache.get_many(keys)
         except (ConnectionRefusedError, MemcacheError):
             raise exceptions.APIException('memcached service is not ready!')
 
-        if block_times and block_times >= 2:
-            raise exceptions.APIException('your ip address is blocked, will be auto resume after 2 hours')
-
-        # 记录1秒内某个ip的请求频率
-        request_times = cache.get(client_ip)
-        if not request_times:
-            request_times = 0
-        cache.set(client_ip, request_times+1, 1)
-
-        # 当1秒内请求次数超过20次，将ip列入黑名单，加入黑名单次数达到2次后，禁止该ip访问
-        # print(request_times)
-        if request_times >= 30:
-            if not block_times:
-                block_times = 0
-            cache.set(block_key, block_times+1, 7200)
-            # 第一次提醒用户超过频率太高
-            raise exceptions.ParseError('your operation frequency is too high')
-
-        # 对外api使用access_key secret_key访问接口
-        # 对外api可以不需要token，直接利用ak/sk找到对应的用户，然后进行default_permission检查
+        self.verify_request_rate(client_ip, values.get(block_key, None))
+
+        # 对外api可以不需要token，直接利用ak找到对应的用户，然后进行default_permission检查
         # default_permission设置为IsAuthenticated，即只需要登陆即可
-        if request.path.startswith('/api/objects'):
-            ak = request.GET.get('access_key', None)
+        if ak:
+            if key_info is None:
+                key_info = values.get(ACCESS_KEYS.cache_key(ak), None)
+                if key_info is None:
+                    key_info = self.load_access_key(ak)
+                else:
+                    ACCESS_KEYS.set(ak, key_info, remote=False)
+
+            if signed:
+                return self.verify_signature(request, client_ip, key_info, signed)
+
+            # 兼容在查询字符串中直接传递secret_key的旧的访问方式
             sk = request.GET.get('secret_key', None)
-            if ak and sk:
-                try:
-                    k = Keys.objects.get(user_access_key=ak, user_secret_key=sk)
-                except Keys.DoesNotExist:
-                    k = None
-
-                if k and k.user.is_active:
-                    if client_ip == k.allow_ip or k.allow_ip == '*':
-                        self.verify_user_storage_is_expire(request, k.user)
-                        return k.user, None
-                    else:
-                        raise exceptions.NotAcceptable('your ip not in allow ip list')
+            if key_info and sk and hmac.compare_digest(key_info[1], sk):
+                settings.LOGGER.warning(
+                    'deprecated secret_key query string auth, access_key: %s, source_ip: %s, '
+                    'will be removed in the next release, use signed requests instead' % (ak, client_ip)
+                )
+                return self.authenticate_key_user(request, client_ip, key_info)
 
         auth = request.META.get('HTTP_AUTHORIZATION', b'')
         if isinstance(auth, str):
@@ -83,18 +90,146 @@ class TokenAuthentication(BaseAuthentication):
             msg = _('Invalid token header. Token string should not contain invalid characters.')
             raise exceptions.AuthenticationFailed(msg)
 
-        return self.verify_token_value(token, request)
+        # 预读取的token不存在时传入False，不再重复查询
+        return self.verify_token_value(token, request, values.get('token_%s' % token, False))
+
+    @staticmethod
+    def get_signature_params(request):
+        """
+        获取签名访问的(access_key, 请求时间, 签名)，不是签名访问时返回None
+
+        签名可以在请求头中传递:
+            Authorization: OSS-HMAC-SHA256 Credential=<access_key>, Signature=<signature>
+            X-Oss-Date: <unix时间戳>
+        也可以在查询字符串中传递access_key、date、signature，用于直接下载的链接
+        """
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        if isinstance(auth, bytes):
+            auth = auth.decode(HTTP_HEADER_ENCODING, 'ignore')
+        if auth.startswith(SIGN_ALGORITHM + ' '):
+            params = dict()
+            for i in auth[len(SIGN_ALGORITHM):].split(','):
+                k, _, v = i.strip().partition('=')
+                params[k] = v
+            return params.get('Credential', None), request.META.get('HTTP_X_OSS_DATE', None), \
+                params.get('Signature', None)
+
+        if 'signature' in request.GET:
+            return request.GET.get('access_key', None), request.GET.get('date', None), request.GET.get('signature')
+
+        return None
+
+    @staticmethod
+    def load_access_key(ak: str):
+        try:
+            k = Keys.objects.select_related('user').get(user_access_key=ak)
+        except Keys.DoesNotExist:
+            key_info = False
+        else:
+            key_info = (k.user_id, k.user_secret_key, k.allow_ip, k.user.is_active)
+        ACCESS_KEYS.set(ak, key_info)
+        return key_info
+
+    def verify_signature(self, request, client_ip: str, key_info, signed: tuple):
+        ak, date, signature = signed
+        if not key_info or not date or not signature:
+            raise exceptions.AuthenticationFailed(_('Invalid signature.'))
+
+        try:
+            date = int(date)
+        except ValueError:
+            raise exceptions.AuthenticationFailed(_('Invalid signature. Date format wrong.'))
+
+        if abs(time.time() - date) > settings.SIGNATURE_EXPIRE_TIME:
+            raise exceptions.AuthenticationFailed(_('Invalid signature. Signature expire.'))
+
+        params = [(k, v) for k, values in request.GET.lists() for v in values]
+        expected = sign(key_info[1], request.method, request.path, params, date)
+        if not hmac.compare_digest(expected, signature):
+            raise exceptions.AuthenticationFailed(_('Invalid signature. Signature not match.'))
+
+        return self.authenticate_key_user(request, client_ip, key_info)
+
+    def authenticate_key_user(self, request, client_ip: str, key_info):
+        user_id, _sk, allow_ip, is_active = key_info
+        if not is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        if client_ip != allow_ip and allow_ip != '*':
+            raise exceptions.NotAcceptable('your ip not in allow ip list')
+
+        user = get_user(user_id, get_user_version(user_id))
+        if not user:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        self.verify_user_storage_is_expire(request, quota_expire_time(user))
+        return user, None
+
+    @staticmethod
+    def get_header_token(request):
+        """
+        从请求头中取出token用于预读取，格式不正确时返回None，由后续的校验给出错误信息
+        """
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        if isinstance(auth, bytes):
+            auth = auth.decode(HTTP_HEADER_ENCODING, 'ignore')
+        auth = auth.split()
+        if len(auth) != 2 or auth[0].lower() != 'token' or not auth[1].isalnum() or len(auth[1]) > 64:
+            return None
+        return auth[1]
+
+    @staticmethod
+    def verify_request_rate(client_ip: str, block_times):
+        """
+        固定窗口限制每个ip的请求频率
+
+        计数器的键包含窗口编号，使用原子的incr计数，窗口内超过限制时加入黑名单一次，
+        加入黑名单的次数达到RATE_LIMIT_BLOCK_TIMES后，禁止该ip访问RATE_LIMIT_BLOCK_TIME秒
+        """
+        if block_times and block_times >= settings.RATE_LIMIT_BLOCK_TIMES:
+            raise exceptions.APIException(
+                'your ip address is blocked, will be auto resume after %s seconds' % settings.RATE_LIMIT_BLOCK_TIME
+            )
+
+        window = settings.RATE_LIMIT_WINDOW
+        counter_key = 'rate_%s_%s' % (client_ip, int(time.time() // window))
+        try:
+            request_times = cache.incr(counter_key)
+        except ValueError:
+            # 新的窗口，键不存在，add失败说明其它请求已经创建了该键
+            if cache.add(counter_key, 1, window + 1):
+                request_times = 1
+            else:
+                request_times = cache.incr(counter_key)
+        except (ConnectionRefusedError, MemcacheError):
+            raise exceptions.APIException('memcached service is not ready!')
 
-    def verify_token_value(self, key, request):
+        if request_times <= settings.RATE_LIMIT_REQUESTS:
+            return
+
+        # 只有刚好超过限制的请求将ip加入黑名单，同一个窗口只记录一次
+        if request_times == settings.RATE_LIMIT_REQUESTS + 1:
+            block_key = 'block_ip_%s' % client_ip
+            try:
+                cache.incr(block_key)
+            except ValueError:
+                if not cache.add(block_key, 1, settings.RATE_LIMIT_BLOCK_TIME):
+                    cache.incr(block_key)
+        # 提醒用户操作频率太高
+        raise exceptions.ParseError('your operation frequency is too high')
+
+    def verify_token_value(self, key, request, cache_token=None):
         ua = request.META.get('HTTP_USER_AGENT', 'unknown')
         client_ip = get_client_ip(request)
 
-        cache_token = cache.get('token_%s' % key)
-        if not cache_token:
+        if cache_token is None:
+            cache_token = cache.get('token_%s' % key)
+        if cache_token and len(cache_token) == 4:
+            cache_token = upgrade_token_record(cache_token)
+        if not cache_token or len(cache_token) != 7:
             raise exceptions.AuthenticationFailed(_('Invalid token. '))
 
-        cache_ua, cache_ip, cache_latest_time, cache_user = cache_token
-        if cache_ua != ua:
+        user_id, cache_ua, cache_ip, cache_latest_time, quota_expire, is_active, version = cache_token
+        if cache_ua != hash_user_agent(ua):
             raise exceptions.AuthenticationFailed(_('Invalid token. UserAgent not match.'))
 
         if cache_ip != client_ip:
@@ -103,15 +238,110 @@ class TokenAuthentication(BaseAuthentication):
         if time.time() - cache_latest_time > settings.TOKEN_EXPIRE_TIME:
             raise exceptions.AuthenticationFailed(_('Invalid token. Token expire.'))
 
-        self.verify_user_storage_is_expire(request, cache_user)
-        cache.set('token_%s' % key, (cache_ua, cache_ip, time.time(), cache_user))
-        return cache_user, None
+        # 最近访问时间超过TOKEN_TOUCH_INTERVAL才更新，避免每个请求都写入缓存
+        touch = time.time() - cache_latest_time > settings.TOKEN_TOUCH_INTERVAL
+        current_version = get_user_version(user_id)
+        if current_version is None or current_version != version:
+            # 用户信息已修改，重新加载用户并更新token记录中的用户状态与存储到期时间
+            user = get_user(user_id, current_version, reload=True)
+            if not user:
+                raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+            quota_expire, is_active, version = quota_expire_time(user), user.is_active, current_version
+            touch = True
+        else:
+            user = get_user(user_id, current_version)
+
+        if not user or not is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        self.verify_user_storage_is_expire(request, quota_expire)
+        if touch:
+            cache.set('token_%s' % key, (
+                user_id, cache_ua, cache_ip, time.time(), quota_expire, is_active, version
+            ))
+        return user, None
 
-    def verify_user_storage_is_expire(self, request, user: User):
-        if request.path.startswith('/api/objects') and not user.capacity_quota.valid():
+    @staticmethod
+    def verify_user_storage_is_expire(request, quota_expire: int):
+        if request.path.startswith('/api/objects') and time.time() > quota_expire:
             raise exceptions.NotAcceptable('storage is expired!')
 
 
+# 进程内缓存的用户，按用户id与用户的版本号失效
+USERS = ClientRegistry(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+# 进程内缓存的用户版本号，{user_id: (version, expire_time)}
+_user_versions = dict()
+
+
+def hash_user_agent(ua: str) -> str:
+    return md5(ua.encode()).hexdigest()[:16]
+
+
+def quota_expire_time(user: User) -> int:
+    """
+    用户存储的到期时间，容量为0时视为已到期
+    """
+    q = user.capacity_quota
+    if q.capacity <= 0:
+        return 0
+    return int(q.start_time + q.duration * 86400)
+
+
+def get_user_version(user_id: int):
+    """
+    获取用户的版本号，在进程内缓存USER_VERSION_TTL秒，memcached不可用时返回None
+    """
+    item = _user_versions.get(user_id, None)
+    if item and item[1] > time.monotonic():
+        return item[0]
+
+    versions = user_cache_version(user_id)
+    if versions is None:
+        return None
+    if len(_user_versions) > 10000:
+        _user_versions.clear()
+    _user_versions[user_id] = (versions[0], time.monotonic() + settings.USER_VERSION_TTL)
+    return versions[0]
+
+
+def get_user(user_id: int, version, reload: bool = False):
+    """
+    从进程内缓存中获取用户，每个请求使用一个副本，用户不存在时返回None
+    """
+    user = USERS.get(user_id, version) if version is not None and not reload else None
+    if not user:
+        try:
+            user = User.objects.select_related('capacity_quota').get(pk=user_id)
+        except User.DoesNotExist:
+            return None
+        if version is not None:
+            USERS.set(user_id, version, user)
+    return copy.copy(user)
+
+
+def build_token_record(user: User, ua: str, ip: str) -> tuple:
+    """
+    token记录只包含用户id、ua的摘要、ip、最近访问时间、存储到期时间、用户状态与用户版本号
+    """
+    return (
+        user.pk, hash_user_agent(ua), ip, time.time(), quota_expire_time(user), user.is_active,
+        get_user_version(user.pk)
+    )
+
+
+def upgrade_token_record(cache_token: tuple):
+    """
+    将旧格式的token记录(ua, ip, 最近访问时间, 用户)转换为当前的格式，用户版本号为None，
+    校验时重新加载用户并写回新格式的记录，升级后已登陆的用户不需要重新登陆
+    """
+    cache_ua, cache_ip, cache_latest_time, cache_user = cache_token
+    if not isinstance(cache_user, User):
+        return None
+    return (
+        cache_user.pk, hash_user_agent(cache_ua), cache_ip, cache_latest_time, 0, cache_user.is_active, None
+    )
+
+
 def verify_permission(model_name: str, app_label: str = None):
     """
     验证权限
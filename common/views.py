@@ -6,7 +6,8 @@ from rest_framework.exceptions import ParseError, NotFound
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 
-from common.func import send_phone_verify_code, validate_post_data
+from common.func import send_phone_verify_code, validate_post_data, verify_super_user
+from common.metrics import render
 from common.captcha import Captcha
 from user.models import Profile
 
@@ -75,4 +76,13 @@ def build_qrcode(request):
     img_io = BytesIO()
     img = qr.make_image(fill_color="black", back_color="white")
     img.save(img_io)
-    return HttpResponse(img_io.getvalue(), content_type="image/png")
\ No newline at end of file
+    return HttpResponse(img_io.getvalue(), content_type="image/png")
+
+
+@api_view(('GET',))
+def query_metrics_endpoint(request):
+    """
+    以prometheus文本格式输出所有进程合并后的监控指标，只允许超级管理员访问
+    """
+    verify_super_user(request)
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from objects.objects_usage import rebuild_usage
+
+
+class Command(BaseCommand):
+    help = 'rebuild bucket, user and region usage from the object records'
+
+    def handle(self, *args, **options):
+        total = rebuild_usage()
+        self.stdout.write('rebuilt usage records: %s' % total)
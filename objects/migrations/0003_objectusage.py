@@ -0,0 +1,44 @@
+# Generated by Django 3.2.6 on 2026-10-18 17:50
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def build_usage(apps, schema_editor):
+    Objects = apps.get_model('objects', 'Objects')
+    ObjectUsage = apps.get_model('objects', 'ObjectUsage')
+    records = []
+    files = Objects.objects.filter(type='f')
+    for scope, field in (('b', 'bucket_id'), ('u', 'owner_id'), ('r', 'bucket__bucket_region_id')):
+        for i in files.values(field).annotate(count=Count('obj_id'), size=Sum('file_size')):
+            if i[field] is None:
+                continue
+            records.append(ObjectUsage(
+                scope=scope, scope_id=i[field], object_count=i['count'], file_size=i['size'] or 0
+            ))
+    ObjectUsage.objects.bulk_create(records, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('objects', '0002_alter_objects_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ObjectUsage',
+            fields=[
+                ('usage_id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('scope', models.CharField(choices=[('b', 'bucket'), ('u', 'user'), ('r', 'region')], max_length=1, verbose_name='usage scope')),
+                ('scope_id', models.IntegerField(verbose_name='bucket, user or region id')),
+                ('object_count', models.BigIntegerField(default=0, verbose_name='object count')),
+                ('file_size', models.BigIntegerField(default=0, verbose_name='file size total')),
+                ('update_time', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('scope', 'scope_id')},
+            },
+        ),
+        migrations.RunPython(build_usage, migrations.RunPython.noop),
+    ]
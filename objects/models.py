@@ -64,3 +64,37 @@ class ObjectAcl(models.Model):
             'user_id': self.user,
             'object_id': self.object
         }
+
+
+class ObjectUsage(models.Model):
+    """
+    桶、用户、区域的文件数量与容量，文件对象创建、覆盖、删除时在同一个事务中增量更新
+    """
+    SCOPE = (
+        ('b', 'bucket'),
+        ('u', 'user'),
+        ('r', 'region')
+    )
+    usage_id = models.AutoField(primary_key=True, auto_created=True)
+    scope = models.CharField(verbose_name='usage scope', max_length=1, choices=SCOPE, blank=False)
+    scope_id = models.IntegerField(verbose_name='bucket, user or region id', blank=False)
+    object_count = models.BigIntegerField(verbose_name='object count', default=0)
+    file_size = models.BigIntegerField(verbose_name='file size total', default=0)
+    update_time = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.scope}:{self.scope_id}, count:{self.object_count}, size:{self.file_size}'
+
+    @property
+    def json(self):
+        return {
+            'scope': self.scope,
+            'scope_id': self.scope_id,
+            'object_count': self.object_count,
+            'file_size': self.file_size
+        }
+
+    class Meta:
+        unique_together = (
+            'scope', 'scope_id'
+        )
@@ -77,7 +77,7 @@ class ObjectAclEndpoint(APIView):
         except TypeError:
             raise ParseError('acl_oid is not a number')
 
-        verify_file_owner_and_permission(request, PermAction.RW, self.queryset)
+        verify_file_owner_and_permission(request, PermAction.RW, self.queryset.object)
 
         self.queryset.delete()
 
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+
+class CacheWriter:
+    """
+    边下载边写入缓存的临时文件，完整写入后再原子地移动到缓存目录
+    """
+
+    def __init__(self, object_cache, path: str, size: int):
+        self.object_cache = object_cache
+        self.path = path
+        self.size = size
+        self.written = 0
+        self.tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        self.fp = None
+        self.failed = False
+
+    def write(self, data: bytes):
+        if self.failed:
+            return
+        try:
+            # 开始传输数据时才创建临时文件
+            if not self.fp:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.fp = open(self.tmp_path, 'wb')
+            self.fp.write(data)
+            self.written += len(data)
+        except OSError as e:
+            settings.LOGGER.error('object cache write failed: %s' % e)
+            self.failed = True
+            self.abort()
+
+    def commit(self):
+        """
+        写入的字节数与对象大小一致时，将临时文件移动为缓存文件
+        """
+        # 空对象不缓存
+        if self.failed or not self.fp:
+            return
+        self.fp.close()
+        self.fp = None
+        if self.written != self.size:
+            self._remove_tmp()
+            return
+        try:
+            os.replace(self.tmp_path, self.path)
+        except OSError as e:
+            settings.LOGGER.error('object cache commit failed: %s' % e)
+            self._remove_tmp()
+            return
+        self.object_cache.added(self.size)
+
+    def abort(self):
+        if not self.fp:
+            return
+        self.fp.close()
+        self.fp = None
+        self._remove_tmp()
+
+    def _remove_tmp(self):
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class ObjectCache:
+    """
+    节点本地的对象磁盘缓存
+
+    缓存文件路径为 <root>/<sha1(桶名/key)>/<etag>，对象被覆盖后etag变化，旧的缓存不会再被命中；
+    命中时更新文件的修改时间，总大小超过预算时按修改时间淘汰最久未使用的缓存文件
+    """
+
+    def __init__(self, root: str, max_size: int, max_object_size: int):
+        self.root = root
+        self.max_size = max_size
+        self.max_object_size = max_object_size
+        # 本进程估算的缓存总大小，为None时需要扫描缓存目录
+        self._used = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def open(self, bucket_name: str, key: str, etag: str):
+        """
+        打开缓存文件，未命中时返回None
+        """
+        if not self.enabled or not etag:
+            return None
+        path = self._path(bucket_name, key, etag)
+        try:
+            fp = open(path, 'rb')
+        except OSError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return fp
+
+    def writer(self, bucket_name: str, key: str, etag: str, size: int):
+        """
+        获取写入缓存的writer，对象超过允许缓存的大小时返回None
+        """
+        if not self.enabled or not etag or size > self.max_object_size:
+            return None
+        return CacheWriter(self, self._path(bucket_name, key, etag), size)
+
+    def invalidate(self, bucket_name: str, key: str):
+        """
+        删除对象的所有缓存，对象上传或者删除时调用
+        """
+        if not self.enabled:
+            return
+        shutil.rmtree(self._dir(bucket_name, key), ignore_errors=True)
+
+    def added(self, size: int):
+        with self._lock:
+            if self._used is not None:
+                self._used += size
+            if self._used is None or self._used > self.max_size:
+                self._used = self.evict()
+
+    def evict(self) -> int:
+        """
+        扫描缓存目录，淘汰最久未使用的文件直至总大小低于预算的90%，返回淘汰后的总大小
+        """
+        files = []
+        used = 0
+        if not os.path.isdir(self.root):
+            return 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            try:
+                children = list(os.scandir(entry.path))
+            except OSError:
+                continue
+            for f in children:
+                try:
+                    stat = f.stat()
+                except OSError:
+                    continue
+                # 清理异常中断遗留的临时文件
+                if f.name.endswith('.tmp'):
+                    if stat.st_mtime < time.time() - 3600:
+                        self._remove(f.path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, f.path))
+                used += stat.st_size
+
+        if used <= self.max_size:
+            return used
+
+        files.sort()
+        for _, size, path in files:
+            if used <= self.max_size * 0.9:
+                break
+            if self._remove(path):
+                used -= size
+        return used
+
+    def _dir(self, bucket_name: str, key: str) -> str:
+        digest = hashlib.sha1(('%s/%s' % (bucket_name, key)).encode()).hexdigest()
+        return os.path.join(self.root, digest)
+
+    def _path(self, bucket_name: str, key: str, etag: str) -> str:
+        return os.path.join(self._dir(bucket_name, key), etag.strip('"'))
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
+
+
+OBJECT_CACHE = ObjectCache(
+    settings.OBJECT_CACHE_DIR,
+    settings.OBJECT_CACHE_SIZE,
+    settings.OBJECT_CACHE_MAX_OBJECT_SIZE
+)
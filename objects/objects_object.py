@@ -9,23 +9,53 @@ from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.db.models import Q
 from django.db.utils import IntegrityError
-from django.http import StreamingHttpResponse, Http404
+from django.http import (
+    HttpResponse, HttpResponseRedirect, StreamingHttpResponse, FileResponse, Http404, JsonResponse
+)
 from django.core.cache import cache
 
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.exceptions import ParseError, NotFound
+from rest_framework.exceptions import APIException, ParseError, NotFound
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import AllowAny
 from rest_framework.status import HTTP_201_CREATED
 
-from buckets.models import Buckets, BucketAcl
-from common.func import verify_path, s3_client, validate_post_data, validate_license_expire
+from buckets.models import Buckets
+from common.func import verify_path, s3_client, validate_post_data, validate_license_expire, get_client_ip
+from common.acl import get_authorized_users
+from common.breaker import get_breaker
+from common.limiter import BandwidthLimiter, get_bandwidth_limiter
+from common.metrics import METRICS_REGISTRY, metric_labels
 from common.verify import verify_bucket_name, verify_object_name, verify_object_path, verify_max_length
-from objects.models import Objects, ObjectAcl
+from objects.models import Objects
+from objects.objects_usage import (
+    create_object,
+    save_object,
+    delete_object,
+    get_request_size,
+    verify_user_capacity,
+    reserve_capacity,
+    release_capacity,
+    refresh_capacity,
+    get_upload_reservation,
+    request_reservation
+)
 from objects.serializer import ObjectsSerialize
+from objects.objects_cache import OBJECT_CACHE, CacheWriter
+from objects.objects_transfer import (
+    MultipartUploader,
+    S3StreamUploadHandler,
+    StreamedUploadedFile,
+    PrefetchReader,
+    RangeNotSatisfiable,
+    parse_range_header,
+    presigned_download_url,
+    stream_put_object
+)
 
 import base64
+from io import BytesIO
 
 
 class PermAction(Enum):
@@ -65,22 +95,14 @@ def verify_bucket_owner_and_permission(request, perm: PermAction, bucket: Bucket
             return
 
         if objects.permission == 'private':
-            if request.user != objects.owner and request.user != objects.bucket.user:
+            if not is_owner(request.user, objects.owner_id, objects.bucket.user_id):
                 raise ParseError('file owner not match')
 
         if objects.permission == 'authenticated':
-            object_authorize_user_list = ObjectAcl.objects.filter(
-                object=object, permission__startswith='authenticated-%s' % perm.value
-            ).values_list('user_id', flat=True)
-
-            bucket_authorize_user_list = BucketAcl.objects.filter(
-                bucket=objects.bucket, permission__startswith='authenticated-%s' % perm.value
-            ).values_list('user_id', flat=True)
-
-            authorized_list = set(list(object_authorize_user_list) + list(bucket_authorize_user_list))
-            if request.user.id not in authorized_list and \
-                    request.user != objects.owner and \
-                    request.user != objects.bucket.user:
+            # 桶与文件对象的授权用户集合来自缓存的授权索引
+            authorized = get_authorized_users(perm.value, objects.bucket_id, objects.obj_id)
+            if request.user.id not in authorized and \
+                    not is_owner(request.user, objects.owner_id, objects.bucket.user_id):
                 raise ParseError('No authorize access that file')
 
     if bucket:
@@ -88,43 +110,50 @@ def verify_bucket_owner_and_permission(request, perm: PermAction, bucket: Bucket
             return
 
         if bucket.permission == 'private':
-            if request.user != bucket.user:
+            if not is_owner(request.user, bucket.user_id):
                 raise ParseError('bucket owner not match')
 
         if bucket.permission == 'authenticated':
-            bucket_authorize_user_list = BucketAcl.objects.filter(
-                bucket_id=bucket.bucket_id, permission__startswith='authenticated-%s' % perm.value
-            ).values_list('user_id', flat=True)
-
-            # 请求用户不在桶授权列表内、文件授权列表内、不是桶拥有者、文件拥有者
-            if request.user.id not in list(bucket_authorize_user_list) and \
-                    request.user != bucket.user:
+            authorized = get_authorized_users(perm.value, bucket.bucket_id)
+            # 请求用户不在桶授权列表内、不是桶拥有者
+            if request.user.id not in authorized and not is_owner(request.user, bucket.user_id):
                 raise ParseError('No authorize access that bucket')
 
 
+def is_owner(user, *owner_ids) -> bool:
+    """
+    按用户id比较请求用户是否为拥有者，不需要查询拥有者对象
+    """
+    return user.is_authenticated and user.id in owner_ids
+
+
 @api_view(('PUT',))
 # @verify_permission(model_name='objects')
 @permission_classes((AllowAny,))
 def upload_file_to_bucket_endpoint(request):
     """
     上传文件对象至bucket
+
+    bucket_name、path、permission通过查询字符串传递时，在读取请求体之前完成校验，
+    文件内容边接收边分段写入后端，不落本地磁盘；通过表单字段传递时，文件由django缓存后再上传
     """
     validate_license_expire()
     # req_user = request.user
-    bucket_name = request.POST.get('bucket_name', None)
-    # filename = request.POST.get('filename', None)
-    file = request.FILES.get('file', None)
-    path = request.POST.get('path', None)
-    permission = request.POST.get('permission', None)
-
-    # 如果没有文件，则直接返回400
-    if not file or not bucket_name:
+    streaming = 'bucket_name' in request.GET
+    size = get_request_size(request)
+    if not streaming and request.user.is_authenticated:
+        # 表单上传的桶名在请求体中，读取请求体之前只能按上传用户自己的剩余容量验证，
+        # 避免超出容量的请求体被完整解析并缓存到本地磁盘，读取请求体之后再按桶所有者的容量预留
+        verify_user_capacity(request.user, size)
+    params = request.GET if streaming else request.POST
+    bucket_name = params.get('bucket_name', None)
+    path = params.get('path', None)
+    permission = params.get('permission', None)
+
+    # 如果没有桶名，则直接返回400
+    if not bucket_name:
         raise ParseError(detail='some required field is mission')
 
-    filename = '%s' % file.name
-    if not validate_special_char(filename):
-        raise ParseError(detail='filename contains some special char')
-
     # 验证bucket是否为异常bucket
     try:
         b = Buckets.objects.select_related('bucket_region').get(name=bucket_name)
@@ -149,63 +178,77 @@ def upload_file_to_bucket_endpoint(request):
         if not p:
             raise ParseError(detail='illegal path')
 
-    # 验证文件名是否超长
-    if len(filename) > 1024:
-        raise ParseError(detail='filename is too long')
-
-    md5 = hashlib.md5()
-
     if p:
         root = path
     else:
         root = ''
 
-    if b.version_control:
-        file_key = root + '%s_%s' % (
-            str(time.time()).replace('.', ''),
-            filename
-        )
-    else:
-        file_key = root + filename
+    def build_file_key(filename: str) -> str:
+        if not validate_special_char(filename):
+            raise ParseError(detail='filename contains some special char')
 
-    try:
+        # 验证文件名是否超长
+        if len(filename) > 1024:
+            raise ParseError(detail='filename is too long')
 
-        s3 = s3_client(
-            b.bucket_region_id,
-            b.user.username
-        )
+        if b.version_control:
+            return root + '%s_%s' % (
+                str(time.time()).replace('.', ''),
+                filename
+            )
+        return root + filename
 
-        # multipart uploader
-        uploader = s3.create_multipart_upload(
-            Bucket=b.name,
-            Key=file_key,
-        )
+    # 按Content-Length预留桶所有者的容量，文件对象计入用量后释放
+    with request_reservation(b.user, size):
+        return upload_file(request, b, streaming, build_file_key, root, permission)
 
-        n = 1
-        parts = []
-        for data in file.chunks(chunk_size=5 * 1024 ** 2):
-            md5.update(data)
-            part = s3.upload_part(
-                Body=data,
-                Bucket=b.name,
-                ContentLength=len(data),
-                Key=file_key,
-                UploadId=uploader['UploadId'],
-                PartNumber=n
-            )
-            parts.append({
-                'ETag': part['ETag'].replace('"', ''),
-                'PartNumber': n
-            })
-            n += 1
 
-        # multipart completed upload
-        completed = s3.complete_multipart_upload(
-            Bucket=b.name,
-            Key=file_key,
-            UploadId=uploader['UploadId'],
-            MultipartUpload={'Parts': parts}
-        )
+def upload_file(request, b: Buckets, streaming: bool, build_file_key, root: str, permission: str):
+    """
+    接收上传的文件写入后端，并创建或更新文件对象记录
+    """
+    s3 = s3_client(
+        b.bucket_region_id,
+        b.user.username
+    )
+
+    handler = None
+    if streaming:
+        handler = S3StreamUploadHandler(request, s3, b.name, build_file_key, b.bucket_region.multipart_chunksize)
+        request.upload_handlers = [handler]
+
+    try:
+        file = request.FILES.get('file', None)
+    except Exception as e:
+        if handler:
+            handler.abort()
+        if isinstance(e, APIException):
+            raise
+        raise ParseError(detail=str(e))
+
+    # 如果没有文件，则直接返回400
+    if not file:
+        raise ParseError(detail='some required field is mission')
+
+    filename = '%s' % file.name
+
+    try:
+        if isinstance(file, StreamedUploadedFile):
+            file_key = file.key
+            md5 = file.md5
+            completed = file.completed
+        else:
+            file_key = build_file_key(filename)
+            # 并发分段上传，md5按分段顺序计算
+            uploader = MultipartUploader(s3, b.name, file_key).start()
+            try:
+                for data in file.chunks(chunk_size=b.bucket_region.multipart_chunksize):
+                    uploader.add_part(data)
+                completed = uploader.complete()
+            except Exception:
+                uploader.abort()
+                raise
+            md5 = uploader.md5.hexdigest()
 
         # 创建或更新数据库
         record_data = {
@@ -215,7 +258,7 @@ def upload_file_to_bucket_endpoint(request):
             'root': root,
             'file_size': file.size,
             'key': file_key,
-            'md5': md5.hexdigest(),
+            'md5': md5,
             'etag': completed['ETag'] if 'ETag' in completed else None,
             'version_id': completed['VersionId'] if 'VersionId' in completed else None,
             'owner_id': b.user.id,
@@ -223,20 +266,25 @@ def upload_file_to_bucket_endpoint(request):
         }
 
         try:
-            o = Objects.objects.get(bucket=b, key=file_key)
+            o = Objects.objects.select_related('bucket').get(bucket=b, key=file_key)
         except Objects.DoesNotExist:
-            o = Objects.objects.create(**record_data)
+            o = create_object(b, **record_data)
         else:
+            old_size = o.file_size
+            o.file_size = record_data['file_size']
             o.md5 = record_data['md5']
             o.etag = record_data['etag']
             # o.owner_id = record_data['owner_id']
             o.version_id = record_data['version_id']
-            o.save()
+            save_object(o, old_size)
+        OBJECT_CACHE.invalidate(b.name, file_key)
 
         # backup upload object on the background thread
         if b.backup:
             threading.Thread(target=backup_object, args=(o,)).start()
 
+    except APIException:
+        raise
     except Exception as e:
         raise ParseError(detail=str(e))
 
@@ -426,14 +474,17 @@ def delete_object_endpoint(request):
             Bucket=backup_bucket.name,
             Key=object_key
         )
-        Objects.objects.filter(bucket=backup_bucket, key=object_key).delete()
+        for backup_obj in Objects.objects.select_related('bucket').filter(bucket=backup_bucket, key=object_key):
+            delete_object(backup_obj)
+        OBJECT_CACHE.invalidate(backup_bucket.name, object_key)
 
     for del_id, del_key in delete_list:
         s3.delete_object(
             Bucket=o.bucket.name,
             Key=del_key
         )
-        Objects.objects.get(obj_id=del_id).delete()
+        delete_object(Objects.objects.select_related('bucket').get(obj_id=del_id))
+        OBJECT_CACHE.invalidate(o.bucket.name, del_key)
         if 'backup_s3' in dir():
             threading.Thread(target=remove_backup, args=(del_key,)).start()
         # t = threading.Thread(target=remove_backup, args=(del_key,))
@@ -470,22 +521,15 @@ def download_object_endpoint(request):
     verify_bucket_owner_and_permission(request, PermAction.R, objects=obj)
 
     try:
-        s3 = s3_client(obj.bucket.bucket_region.reg_id, obj.bucket.user.username)
-        if isinstance(request.user, AnonymousUser):
-            bandwidth = settings.USER_MIN_BANDWIDTH
-        else:
-            bandwidth = request.user.bandwidth_quota.user_bandwidth()
-
-        res = StreamingHttpResponse(iterate_down_file_from_s3(s3, obj, bandwidth))
-        res['Content-Type'] = 'application/octet-stream'
-        res['Content-Length'] = obj.file_size
-        res['Content-Disposition'] = 'attachment;filename="%s"' % obj.name.encode().decode('ISO-8859-1')
-        return res
+        limiter = get_download_limiter(request, request.user)
+        return build_download_response(request, obj, limiter)
 
     # except ClientError as e:
     #     raise NotFound(e.args[0])
     # except ConnectionError as e:
     #     raise ParseError(e.args[0])
+    except APIException:
+        raise
     except Exception as e:
         raise ParseError(e.args[0])
 
@@ -555,7 +599,15 @@ def put_object_to_bucket_endpoint(request):
         permission = bucket.permission
 
     verify_bucket_owner_and_permission(request, PermAction.RW, bucket=bucket)
+    # 按Content-Length预留桶所有者的容量，文件对象计入用量后释放
+    with request_reservation(bucket.user, get_request_size(request)):
+        return put_object(request, bucket, key, permission)
 
+
+def put_object(request, bucket: Buckets, key: str, permission: str):
+    """
+    将请求体写入后端，并创建或更新文件对象记录
+    """
     root, name = os.path.split(key)
 
     if root:
@@ -565,34 +617,40 @@ def put_object_to_bucket_endpoint(request):
         name = f'{int(time.time())}_{name}'
     try:
         s3 = s3_client(bucket.bucket_region.reg_id, bucket.user.username)
-        result = s3.put_object(
-            Bucket=bucket_name,
-            Body=request.body,
-            Key=key
+        # 分块读取请求体写入后端，不将整个对象读入内存
+        result = stream_put_object(
+            s3,
+            bucket.name,
+            key,
+            request.stream if request.stream else BytesIO(),
+            bucket.bucket_region.multipart_threshold,
+            bucket.bucket_region.multipart_chunksize
         )
 
     except ClientError as e:
         raise ParseError(e.args[0])
 
     try:
-        o = Objects.objects.get(bucket=bucket, key=key)
-        o.file_size = len(request.body)
-        o.md5 = hashlib.md5(request.body).hexdigest()
-        o.etag = result['ETag'].replace('"', '')
-        o.save()
+        o = Objects.objects.select_related('bucket').get(bucket=bucket, key=key)
+        old_size = o.file_size
+        o.file_size = result['size']
+        o.md5 = result['md5']
+        o.etag = result['etag']
+        save_object(o, old_size)
     except Objects.DoesNotExist:
-        o = Objects.objects.create(
+        o = create_object(
+            bucket,
             root=root+'/',
             type='f',
             name=name,
             key=key,
             permission=permission,
-            file_size=len(request.body),
-            bucket_id=bucket.bucket_id,
+            file_size=result['size'],
             owner_id=bucket.user.id,
-            etag=result['ETag'].replace('"', ''),
-            md5=hashlib.md5(request.body).hexdigest()
+            etag=result['etag'],
+            md5=result['md5']
         )
+    OBJECT_CACHE.invalidate(bucket.name, key)
 
     if bucket.backup:
         backup_object(o)
@@ -610,10 +668,17 @@ def init_multipart_upload_endpoint(request):
     bucket_name = request.POST.get('bucket_name', None)
     key = request.POST.get('key', None)
     permission = request.POST.get('permission', None)
+    # 上传文件的总大小，用于上传前验证并预留容量
+    size = request.POST.get('size', None)
 
     if not bucket_name or not key:
         raise ParseError('not bucket_name or key')
 
+    if size is not None:
+        if not size.isdigit():
+            raise ParseError('illegal size value')
+        size = int(size)
+
     if len(key) > 2048:
         raise ParseError('key value is to long')
 
@@ -634,15 +699,27 @@ def init_multipart_upload_endpoint(request):
         permission = bucket.permission
 
     verify_bucket_owner_and_permission(request, PermAction.RW, bucket=bucket)
+    verify_user_capacity(bucket.user, size)
     try:
         s3 = s3_client(bucket.bucket_region.reg_id, bucket.user.username)
         result = s3.create_multipart_upload(
             Bucket=bucket.name,
             Key=key,
         )
+    except APIException:
+        raise
     except Exception as e:
         raise ParseError(e.args[0])
 
+    try:
+        reserve_capacity(bucket.user, result['UploadId'], size)
+    except ParseError:
+        # 并发的上传已经占用了剩余容量，取消本次分段上传
+        try:
+            s3.abort_multipart_upload(Bucket=bucket.name, Key=key, UploadId=result['UploadId'])
+        except Exception as e:
+            settings.LOGGER.error('abort multipart upload failed: %s' % e)
+        raise
     cache.set(result['UploadId'], (bucket, permission, result, key), 3600)
 
     if 'ResponseMetadata' in result:
@@ -664,6 +741,16 @@ def upload_part_endpoint_endpoint(request):
         raise ParseError('not found this upload id')
 
     bucket, _, uploader, key = cache.get(upload_id)
+    # 长时间的上传在每次上传分段时刷新上传id与预留容量的有效期
+    cache.touch(upload_id, 3600)
+    cache.touch(f'{upload_id}_filesize', 3600)
+    refresh_capacity(upload_id)
+    # 已上传的分段超过初始化时预留的容量后，每个分段在读取请求体之前验证剩余容量
+    part_size = get_request_size(request)
+    if part_size is not None:
+        total = cache.get(f'{upload_id}_filesize', 0) + part_size
+        if total > get_upload_reservation(upload_id):
+            verify_user_capacity(bucket.user, total, upload_id)
     try:
         s3 = s3_client(bucket.bucket_region.reg_id, bucket.user.username)
         result = s3.upload_part(
@@ -674,14 +761,17 @@ def upload_part_endpoint_endpoint(request):
             UploadId=uploader['UploadId'],
             PartNumber=part
         )
+    except APIException:
+        raise
     except Exception as e:
         raise ParseError(e.args[0])
 
-    part_size = cache.get(f'{upload_id}_filesize')
-    if not part_size:
-        cache.set(f'{upload_id}_filesize', len(request.body), 3600)
-    else:
-        cache.set(f'{upload_id}_filesize', part_size+len(request.body), 3600)
+    # 并发上传分段时原子地累加大小
+    try:
+        cache.incr(f'{upload_id}_filesize', len(request.body))
+    except ValueError:
+        if not cache.add(f'{upload_id}_filesize', len(request.body), 3600):
+            cache.incr(f'{upload_id}_filesize', len(request.body))
 
     return Response({
         'code': 0,
@@ -722,35 +812,47 @@ def completed_multipart_upload_endpoint(request):
             UploadId=uploader['UploadId'],
             MultipartUpload={'Parts': parts}
         )
+    except APIException:
+        raise
     except Exception as e:
         raise ParseError(e.args[0])
 
     root, name = os.path.split(key)
     file_size = cache.get(f'{upload_id}_filesize')
+    if file_size is None:
+        # 缓存中的分段大小丢失时从后端获取对象大小
+        try:
+            file_size = s3.head_object(Bucket=bucket.name, Key=key)['ContentLength']
+        except Exception as e:
+            settings.LOGGER.error('get multipart object size failed: %s' % e)
+            file_size = 0
     if root:
         generate_folder_by_key(bucket, key)
     if bucket.version_control:
         name = f'{int(time.time())}_{name}'
 
     try:
-        o = Objects.objects.get(bucket=bucket, key=key)
+        o = Objects.objects.select_related('bucket').get(bucket=bucket, key=key)
+        old_size = o.file_size
         o.file_size = file_size
         o.etag = result['ETag'].replace('"', '')
-        o.save()
+        save_object(o, old_size)
     except Objects.DoesNotExist:
-        o = Objects.objects.create(
+        o = create_object(
+            bucket,
             root=root+'/',
             type='f',
             name=name,
             key=key,
             permission=permission,
-            file_size=0,
-            bucket_id=bucket.bucket_id,
+            file_size=file_size,
             owner_id=bucket.user.id,
             etag=result['ETag'].replace('"', ''),
         )
+    OBJECT_CACHE.invalidate(bucket.name, key)
     if bucket.backup:
         backup_object(o)
+    release_capacity(bucket.user_id, upload_id)
     cache.delete(f'{upload_id}')
     cache.delete(f'{upload_id}_filesize')
     if 'ResponseMetadata' in result:
@@ -796,26 +898,157 @@ def abort_multipart_upload_endpoint(request):
             Key=key,
             UploadId=upload_id,
         )
+    except APIException:
+        raise
     except Exception as e:
         raise ParseError(e.args[0])
 
     if cache.get(upload_id):
         cache.delete(upload_id)
+    release_capacity(bucket.user_id, upload_id)
+    cache.delete(f'{upload_id}_filesize')
     return Response(result)
 
 
 def download_file_from_url(request, token):
     down_obj = cache.get(token)
     if not token or not down_obj:
-        return Http404
+        raise Http404
+
+    obj, req_user = down_obj[:2]
+    limiter = get_download_limiter(request, req_user)
+    try:
+        # 只有服务端开启重定向且下载用户属于UNSHAPED_BANDWIDTH中不限速的用户时，才重定向到后端的预签名链接，
+        # 其余下载都经过限速器
+        if settings.DOWNLOAD_URL_REDIRECT and limiter.rate <= 0:
+            return redirect_to_presigned_url(request, obj, req_user)
+        return build_download_response(request, obj, limiter)
+    except APIException as e:
+        # 该视图不经过rest framework的异常处理，区域熔断等异常按异常的状态码返回，而不是500
+        return JsonResponse({'detail': e.detail}, status=e.status_code)
+
+
+def get_download_limiter(request, user) -> BandwidthLimiter:
+    """
+    匿名用户按ip地址限速，登陆用户的所有下载共享同一个限速器
+    """
+    if isinstance(user, AnonymousUser):
+        return get_bandwidth_limiter('ip_%s' % get_client_ip(request), settings.USER_MIN_BANDWIDTH)
+    return get_bandwidth_limiter(user.id, user.bandwidth_quota.user_bandwidth())
 
-    obj, req_user = down_obj
+
+def redirect_to_presigned_url(request, obj: Objects, user):
+    """
+    重定向到对象所在区域的短期预签名链接，客户端直接从后端下载，下载流量按对象大小计入监控指标
+    """
     s3 = s3_client(obj.bucket.bucket_region.reg_id, obj.bucket.user.username)
-    bandwidth = req_user.bandwidth_quota.user_bandwidth()
+    url = presigned_download_url(
+        s3, obj.bucket.name, obj.key, settings.DOWNLOAD_PRESIGNED_EXPIRE,
+        filename=obj.name.encode().decode('ISO-8859-1')
+    )
+    settings.LOGGER.info(
+        'download redirect, user: %s, source_ip: %s, bucket: %s, key: %s, content-length: %s' % (
+            user.username if not isinstance(user, AnonymousUser) else 'AnonymousUser',
+            get_client_ip(request), obj.bucket.name, obj.key, obj.file_size
+        )
+    )
+    labels = metric_labels(region=obj.bucket.bucket_region.reg_id)
+    METRICS_REGISTRY.inc('oss_download_redirects_total', labels)
+    METRICS_REGISTRY.inc('oss_download_redirect_bytes_total', labels, obj.file_size)
+    return HttpResponseRedirect(url)
+
 
-    res = StreamingHttpResponse(iterate_down_file_from_s3(s3, obj, bandwidth))
+def build_download_response(request, obj: Objects, limiter: BandwidthLimiter):
+    """
+    构建文件下载响应，支持Range请求头，可用于断点续传与多线程分段下载
+    本地缓存命中时直接读取本地磁盘，未命中的完整下载在传输的同时写入本地缓存
+    """
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE', None)
+    # If-Range与对象当前的etag不一致时，说明对象已经变化，返回完整对象
+    if not if_range or if_range.strip('"') == (obj.etag or '').strip('"'):
+        try:
+            byte_range = parse_range_header(request.META.get('HTTP_RANGE', None), obj.file_size)
+        except RangeNotSatisfiable:
+            res = HttpResponse(status=416)
+            res['Content-Range'] = 'bytes */%s' % obj.file_size
+            res['Accept-Ranges'] = 'bytes'
+            return res
+
+    fp = OBJECT_CACHE.open(obj.bucket.name, obj.key, obj.etag)
+    res = build_offload_response(obj, limiter, fp, byte_range)
+    if res is not None:
+        return set_download_headers(res, obj)
+
+    if fp:
+        stream = iterate_file_from_cache(fp, limiter, byte_range)
+    else:
+        # 数据在响应开始后才从后端读取，区域已熔断时在返回响应之前失败
+        get_breaker(obj.bucket.bucket_region.reg_id).check()
+        s3 = s3_client(obj.bucket.bucket_region.reg_id, obj.bucket.user.username)
+        writer = None if byte_range else OBJECT_CACHE.writer(obj.bucket.name, obj.key, obj.etag, obj.file_size)
+        stream = iterate_down_file_from_s3(s3, obj, limiter, byte_range, writer)
+
+    if byte_range:
+        start, end = byte_range
+        res = StreamingHttpResponse(stream, status=206)
+        res['Content-Range'] = 'bytes %s-%s/%s' % (start, end, obj.file_size)
+        res['Content-Length'] = end - start + 1
+    else:
+        res = StreamingHttpResponse(stream)
+        res['Content-Length'] = obj.file_size
+
+    return set_download_headers(res, obj)
+
+
+def build_offload_response(obj: Objects, limiter: BandwidthLimiter, fp, byte_range: tuple = None):
+    """
+    根据DOWNLOAD_OFFLOAD将数据传输交给uwsgi的offload线程或者前端代理，worker不再逐块转发数据
+    返回None时由worker自行传输
+
+    offload的传输不经过按用户共享的限速器，只对UNSHAPED_BANDWIDTH中不限速的用户offload，限速用户的下载仍由worker限速传输
+    """
+    mode = settings.DOWNLOAD_OFFLOAD
+    if limiter.rate > 0:
+        return None
+    if mode == 'uwsgi':
+        # 本地缓存的完整对象通过wsgi.file_wrapper交给uwsgi的offload线程发送，Range请求仍由worker处理
+        if not fp or byte_range:
+            return None
+        res = FileResponse(fp)
+        res['Content-Length'] = obj.file_size
+        return res
+
+    if mode == 'x-sendfile':
+        if not fp:
+            return None
+        fp.close()
+        res = HttpResponse()
+        res['X-Sendfile'] = os.path.abspath(fp.name)
+        return res
+
+    if mode == 'x-accel-redirect':
+        if fp:
+            fp.close()
+            location = settings.DOWNLOAD_ACCEL_CACHE_PREFIX + os.path.relpath(fp.name, settings.OBJECT_CACHE_DIR)
+        else:
+            # 未命中缓存时由前端代理通过预签名链接直接从后端拉取
+            s3 = s3_client(obj.bucket.bucket_region.reg_id, obj.bucket.user.username)
+            url = presigned_download_url(s3, obj.bucket.name, obj.key, settings.DOWNLOAD_PRESIGNED_EXPIRE)
+            location = settings.DOWNLOAD_ACCEL_PROXY_PREFIX + url.replace('://', '/', 1)
+        res = HttpResponse()
+        res['X-Accel-Redirect'] = location
+        # Range请求由前端代理处理
+        return res
+
+    return None
+
+
+def set_download_headers(res, obj: Objects):
     res['Content-Type'] = 'application/octet-stream'
-    res['Content-Length'] = obj.file_size
+    res['Accept-Ranges'] = 'bytes'
+    if obj.etag:
+        res['ETag'] = '"%s"' % obj.etag.strip('"')
     res['Content-Disposition'] = 'attachment;filename="%s"' % obj.name.encode().decode('ISO-8859-1')
     return res
 
@@ -850,35 +1083,66 @@ def generate_folder_by_key(bucket: Buckets, key: str):
         root += i + '/'
 
 
-def iterate_down_file_from_s3(s3, download_obj: Objects, bandwidth: int):
-    n = 0
-    transfer_count = 0
-    ts = time.time()
-    min_unit = 1024 ** 2
+def iterate_down_file_from_s3(s3, download_obj: Objects, limiter: BandwidthLimiter, byte_range: tuple = None,
+                              cache_writer: CacheWriter = None):
+    # 只向上游ceph发起一次请求，然后分块读取响应的字节流数据(单位为字节，非比特，不用转换)
+    kwargs = {
+        'Bucket': download_obj.bucket.name,
+        'Key': download_obj.key,
+    }
+    # 客户端请求的区间直接对应一次后端的区间请求
+    if byte_range:
+        kwargs['Range'] = 'bytes=%s-%s' % byte_range
+    try:
+        ret_data = s3.get_object(**kwargs)
+    except ClientError as e:
+        raise ParseError(e.args)
 
-    while 1:
-        # 分段从上游ceph上面下载字节流数据(单位为字节，非比特，不用转换)
-        try:
-            ret_data = s3.get_object(
-                Bucket=download_obj.bucket.name,
-                Key=download_obj.key,
-                Range='bytes=%s-%s' % (n, n + min_unit - 1),
-            )
-        except ClientError as e:
-            raise ParseError(e.args)
-
-        n += min_unit
-        data = ret_data['Body'].read()
-        transfer_count += min_unit
-        # print('already_transfer:', transfer_count, 'bandwidth_transfer:', bandwidth*min_unit, time.time()-ts)
-        if transfer_count >= bandwidth * min_unit:
-            if time.time() - ts < 1:
-                time.sleep(1 - (time.time() - ts))
-                ts = time.time()
-            transfer_count = 0
-        yield data
-        if n > download_obj.file_size:
-            break
+    body = ret_data['Body']
+    # 开启预读取时，由后台线程提前从后端读取数据
+    if settings.DOWNLOAD_PREFETCH_DEPTH > 0:
+        chunks = PrefetchReader(body)
+    else:
+        chunks = body.iter_chunks(chunk_size=settings.DOWNLOAD_CHUNK_SIZE)
+    labels = metric_labels(region=download_obj.bucket.bucket_region.reg_id)
+    try:
+        for data in chunks:
+            if cache_writer:
+                cache_writer.write(data)
+            # 按用户共享的令牌桶限速，令牌不足时等待
+            limiter.consume(len(data))
+            METRICS_REGISTRY.inc('oss_download_bytes_total', labels, len(data))
+            yield data
+        # 完整传输后才写入缓存
+        if cache_writer:
+            cache_writer.commit()
+    finally:
+        if cache_writer:
+            cache_writer.abort()
+        if isinstance(chunks, PrefetchReader):
+            chunks.close()
+        body.close()
+
+
+def iterate_file_from_cache(fp, limiter: BandwidthLimiter, byte_range: tuple = None):
+    """
+    从本地缓存文件中读取对象数据
+    """
+    start, end = byte_range if byte_range else (0, None)
+    remaining = end - start + 1 if byte_range else None
+    try:
+        fp.seek(start)
+        while remaining is None or remaining > 0:
+            size = settings.DOWNLOAD_CHUNK_SIZE if remaining is None else min(remaining, settings.DOWNLOAD_CHUNK_SIZE)
+            data = fp.read(size)
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            limiter.consume(len(data))
+            yield data
+    finally:
+        fp.close()
 
 
 def backup_object(origin: Objects):
@@ -933,7 +1197,6 @@ def backup_object(origin: Objects):
         )
         record_data = {
             'name': origin.name,
-            'bucket_id': dest_bucket.bucket_id,
             'type': 'f',
             'root': origin.root,
             'file_size': origin.file_size,
@@ -943,10 +1206,15 @@ def backup_object(origin: Objects):
             'version_id': completed['VersionId'] if 'VersionId' in completed else None,
             'owner_id': origin.owner_id,
         }
-        if origin.bucket.version_control:
-            result = Objects.objects.create(**record_data)
+        record_data['permission'] = origin.permission
+        result = None
+        if not origin.bucket.version_control:
+            result = Objects.objects.select_related('bucket').filter(bucket=dest_bucket, key=origin.key).first()
+        if result:
+            old_size = result.file_size
+            for k, v in record_data.items():
+                setattr(result, k, v)
+            save_object(result, old_size)
         else:
-            result, created = Objects.objects.update_or_create(**record_data)
-
-        result.permission = origin.permission
-        result.save()
+            result = create_object(dest_bucket, **record_data)
+        OBJECT_CACHE.invalidate(dest_bucket.name, origin.key)
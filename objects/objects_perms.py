@@ -1,14 +1,14 @@
-from rest_framework.exceptions import ParseError, NotFound
+from rest_framework.exceptions import ParseError, NotFound, APIException
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 
 from common.tokenauth import verify_permission
 from common.verify import verify_pk, verify_in_array
 from common.func import s3_client, validate_post_data
-from .models import Objects, ObjectAcl
+from .models import Objects
 
-from buckets.models import BucketAcl
-from objects.objects_object import PermAction
+from common.acl import get_authorized_users
+from objects.objects_object import PermAction, is_owner
 
 
 def verify_file_owner_and_permission(request, perm: PermAction, objects: Objects):
@@ -20,23 +20,14 @@ def verify_file_owner_and_permission(request, perm: PermAction, objects: Objects
     :return if has permission then pass else raise a exception
     """
     if objects.permission == 'private':
-        if request.user != objects.owner and request.user != objects.bucket.user:
+        if not is_owner(request.user, objects.owner_id, objects.bucket.user_id):
             raise ParseError('object and owner not match')
 
     if objects.permission == 'authenticated':
-        object_authorize_user_list = ObjectAcl.objects.filter(
-            object_id=objects.obj_id, permission__startswith='authenticated-%s' % perm.value
-        ).values_list('user_id', flat=True)
-
-        bucket_authorize_user_list = BucketAcl.objects.filter(
-            bucket=objects.bucket, permission__startswith='authenticated-%s' % perm.value
-        ).values_list('user_id', flat=True)
-
-        allow_user_list = set(list(object_authorize_user_list)+list(bucket_authorize_user_list))
+        allow_user_list = get_authorized_users(perm.value, objects.bucket_id, objects.obj_id)
         # 桶拥有者、文件对象拥有者、已授权
         if request.user.id not in allow_user_list and \
-                request.user != objects.bucket.user and \
-                request.user != objects.owner:
+                not is_owner(request.user, objects.owner_id, objects.bucket.user_id):
             raise ParseError('current user cant allow access this object')
 
 
@@ -71,6 +62,8 @@ def set_object_perm_endpoint(request):
             )
         o.permission = data['permission']
         o.save()
+    except APIException:
+        raise
     except Exception as e:
         raise ParseError(detail=str(e))
 
@@ -0,0 +1,405 @@
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopFutureHandlers
+
+from common.metrics import METRICS_REGISTRY
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class MultipartUploader:
+    """
+    并发分段上传器
+
+    使用有界线程池同时上传多个分段，已读取但未上传完成的分段数量不超过max_buffer，
+    以此限制每个上传占用的内存。md5按分段的读取顺序计算，分段列表按分段编号组装
+    """
+
+    def __init__(self, s3, bucket_name: str, key: str, workers: int = None, max_buffer: int = None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.workers = workers if workers else settings.UPLOAD_CONCURRENCY
+        self.max_buffer = max_buffer if max_buffer else settings.UPLOAD_MAX_BUFFERED_PARTS
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.upload_id = None
+
+        self._part_number = 0
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(max(self.max_buffer, self.workers))
+        self._executor = None
+
+    def start(self):
+        """
+        在后端创建分段上传任务
+        """
+        uploader = self.s3.create_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.key,
+        )
+        self.upload_id = uploader['UploadId']
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def add_part(self, data: bytes):
+        """
+        按顺序提交一个分段，缓冲的分段数量达到上限时阻塞，直至有分段上传完成
+        """
+        self._raise_failed()
+        self.md5.update(data)
+        self.size += len(data)
+        self._part_number += 1
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._upload_part, self._part_number, data)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append(future)
+
+    def complete(self) -> dict:
+        """
+        等待所有分段上传完成，然后合并分段
+        """
+        # s3不允许没有分段的合并请求，空文件则上传一个空的分段
+        if not self._futures:
+            self.add_part(b'')
+
+        try:
+            parts = [f.result() for f in self._futures]
+        finally:
+            self._executor.shutdown(wait=True)
+
+        return self.s3.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+
+    def abort(self):
+        """
+        取消未开始的分段，并终止后端的分段上传任务
+        """
+        for f in self._futures:
+            f.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        if not self.upload_id:
+            return
+        try:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                UploadId=self.upload_id,
+            )
+        except Exception as e:
+            settings.LOGGER.error('abort multipart upload %s failed: %s' % (self.upload_id, e))
+
+    def _upload_part(self, part_number: int, data: bytes) -> dict:
+        part = self.s3.upload_part(
+            Body=data,
+            Bucket=self.bucket_name,
+            ContentLength=len(data),
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number
+        )
+        return {
+            'ETag': part['ETag'].replace('"', ''),
+            'PartNumber': part_number
+        }
+
+    def _raise_failed(self):
+        # 已有分段上传失败时，不再继续读取与提交后续分段
+        for f in self._futures:
+            if f.done() and not f.cancelled() and f.exception():
+                raise f.exception()
+
+
+class StreamedUploadedFile(UploadedFile):
+    """
+    已经由S3StreamUploadHandler写入后端的文件，本身不包含文件内容
+    """
+
+    def __init__(self, name, size, content_type, charset, content_type_extra, key: str, md5: str, completed: dict):
+        super().__init__(BytesIO(), name, content_type, size, charset, content_type_extra)
+        self.key = key
+        self.md5 = md5
+        self.completed = completed
+
+
+class S3StreamUploadHandler(FileUploadHandler):
+    """
+    流式上传处理器
+
+    请求体到达时即按分段写入后端的分段上传任务，边接收边计算md5，文件内容不写入本地磁盘
+    key_builder根据上传的文件名生成对象的key，文件名不合法时由其抛出异常
+    """
+
+    def __init__(self, request, s3, bucket_name: str, key_builder, part_size: int = None):
+        super().__init__(request)
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key_builder = key_builder
+        self.part_size = part_size if part_size else settings.UPLOAD_PART_SIZE
+        self.uploader = None
+        self.completed = False
+        self._buffer = bytearray()
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        # 每个请求只接收file字段中的一个文件
+        if field_name != 'file' or self.uploader:
+            raise SkipFile()
+
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        key = self.key_builder(file_name)
+        self.uploader = MultipartUploader(self.s3, self.bucket_name, key).start()
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._buffer += raw_data
+        if len(self._buffer) >= self.part_size:
+            self._submit_buffer()
+        return None
+
+    def file_complete(self, file_size):
+        if not self.uploader:
+            return None
+
+        try:
+            if self._buffer:
+                self._submit_buffer()
+            completed = self.uploader.complete()
+        except Exception:
+            self.abort()
+            raise
+
+        self.completed = True
+        return StreamedUploadedFile(
+            name=self.file_name,
+            size=file_size,
+            content_type=self.content_type,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+            key=self.uploader.key,
+            md5=self.uploader.md5.hexdigest(),
+            completed=completed
+        )
+
+    def upload_interrupted(self):
+        self.abort()
+
+    def abort(self):
+        """
+        请求体未完整接收时，终止后端的分段上传任务
+        """
+        if self.uploader and not self.completed:
+            self.uploader.abort()
+            self.uploader = None
+        self._buffer = bytearray()
+
+    def _submit_buffer(self):
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+        try:
+            self.uploader.add_part(data)
+        except Exception:
+            self.abort()
+            raise
+
+
+def read_full(stream, size: int) -> bytes:
+    """
+    从输入流中读取size个字节，流结束时返回的数据可能不足size个字节
+    """
+    buff = bytearray()
+    while len(buff) < size:
+        data = stream.read(size - len(buff))
+        if not data:
+            break
+        buff += data
+    return bytes(buff)
+
+
+def stream_put_object(s3, bucket_name: str, key: str, stream, threshold: int = None, part_size: int = None) -> dict:
+    """
+    从输入流分块读取对象内容并写入后端，边读取边计算md5
+
+    对象小于threshold(默认为PUT_OBJECT_MULTIPART_THRESHOLD)时使用一次put_object写入，
+    否则自动切换为并发分段上传，每个请求占用的内存与对象大小无关
+    """
+    threshold = threshold if threshold else settings.PUT_OBJECT_MULTIPART_THRESHOLD
+    part_size = part_size if part_size else settings.UPLOAD_PART_SIZE
+    md5 = hashlib.md5()
+    data = read_full(stream, threshold)
+
+    if len(data) < threshold:
+        md5.update(data)
+        result = s3.put_object(
+            Bucket=bucket_name,
+            Body=data,
+            Key=key
+        )
+        return {
+            'size': len(data),
+            'md5': md5.hexdigest(),
+            'etag': result['ETag'].replace('"', ''),
+            'version_id': result['VersionId'] if 'VersionId' in result else None,
+        }
+
+    uploader = MultipartUploader(s3, bucket_name, key).start()
+    try:
+        while data:
+            uploader.add_part(data)
+            data = read_full(stream, part_size)
+        result = uploader.complete()
+    except Exception:
+        uploader.abort()
+        raise
+
+    return {
+        'size': uploader.size,
+        'md5': uploader.md5.hexdigest(),
+        'etag': result['ETag'].replace('"', ''),
+        'version_id': result['VersionId'] if 'VersionId' in result else None,
+    }
+
+
+def parse_range_header(header: str, size: int):
+    """
+    解析请求头中的Range，只支持单个区间和后缀区间(bytes=-n)
+
+    返回(start, end)，end包含在内；没有Range、格式不合法或请求多个区间时返回None，按完整对象响应
+    区间超出对象大小时抛出RangeNotSatisfiable
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+
+    spec = header[6:].strip()
+    if ',' in spec:
+        return None
+
+    first, sep, last = spec.partition('-')
+    first = first.strip()
+    last = last.strip()
+    if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+
+    if not first:
+        # 后缀区间，请求最后n个字节
+        if not last or int(last) == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - int(last), 0), size - 1
+
+    start = int(first)
+    if last and int(last) < start:
+        return None
+
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def presigned_download_url(s3, bucket_name: str, key: str, expires: int, filename: str = None) -> str:
+    """
+    生成对象的预签名下载链接，filename不为空时由后端在响应中返回附件形式的Content-Disposition
+    """
+    params = {
+        'Bucket': bucket_name,
+        'Key': key,
+    }
+    if filename:
+        params['ResponseContentDisposition'] = 'attachment;filename="%s"' % filename
+    return s3.generate_presigned_url('get_object', Params=params, ExpiresIn=expires)
+
+
+class PrefetchReader:
+    """
+    下载预读取管道
+
+    后台线程从后端响应流中读取数据，填充最多depth个缓冲块的队列，响应迭代器从队列中取数据，
+    使后端的网络往返与向客户端发送数据的时间重叠
+    backend_stall为迭代器等待后端数据的时间，client_stall为后台线程等待客户端取走数据的时间
+    """
+    _END = object()
+
+    def __init__(self, body, chunk_size: int = None, depth: int = None):
+        self.body = body
+        self.chunk_size = chunk_size if chunk_size else settings.DOWNLOAD_CHUNK_SIZE
+        self.depth = depth if depth else settings.DOWNLOAD_PREFETCH_DEPTH
+        self.backend_stall = 0.0
+        self.client_stall = 0.0
+
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._fetch, daemon=True)
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                ts = time.monotonic()
+                item = self._queue.get()
+                self.backend_stall += time.monotonic() - ts
+
+                if item is self._END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        停止后台线程并关闭后端响应流，将本次下载的等待时间计入监控指标
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        # 清空队列，使阻塞在put上的后台线程退出
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self.body.close()
+
+        METRICS_REGISTRY.inc('oss_download_prefetch_streams_total')
+        METRICS_REGISTRY.inc('oss_download_prefetch_backend_stall_seconds_total', value=self.backend_stall)
+        METRICS_REGISTRY.inc('oss_download_prefetch_client_stall_seconds_total', value=self.client_stall)
+
+    def _fetch(self):
+        try:
+            for data in self.body.iter_chunks(chunk_size=self.chunk_size):
+                if not self._put(data):
+                    return
+            self._put(self._END)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item) -> bool:
+        ts = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            self.client_stall += time.monotonic() - ts
+            return True
+        return False
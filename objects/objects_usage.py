@@ -0,0 +1,279 @@
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.utils import IntegrityError
+from rest_framework.exceptions import ParseError
+
+from buckets.models import BucketRegion, Buckets
+from objects.models import Objects, ObjectUsage
+from user.models import CapacityQuota
+
+
+def update_usage(bucket: Buckets, owner_id: int, count: int, size: int):
+    """
+    增量更新桶、用户、区域的用量，需要在调用者的事务中执行
+    """
+    if not count and not size:
+        return
+    scopes = (
+        ('b', bucket.bucket_id),
+        ('u', owner_id),
+        ('r', bucket.bucket_region_id),
+    )
+    for scope, scope_id in scopes:
+        if scope_id is None:
+            continue
+        rows = ObjectUsage.objects.filter(scope=scope, scope_id=scope_id)
+        if rows.update(object_count=F('object_count') + count, file_size=F('file_size') + size):
+            continue
+        try:
+            # 使用保存点，并发创建同一条记录失败时不影响外层事务
+            with transaction.atomic():
+                ObjectUsage.objects.create(scope=scope, scope_id=scope_id, object_count=count, file_size=size)
+        except IntegrityError:
+            rows.update(object_count=F('object_count') + count, file_size=F('file_size') + size)
+
+
+def create_object(bucket: Buckets, **record_data) -> Objects:
+    """
+    创建文件对象记录并更新用量
+    """
+    record_data.pop('bucket_id', None)
+    with transaction.atomic():
+        o = Objects.objects.create(bucket=bucket, **record_data)
+        if o.type == 'f':
+            update_usage(bucket, o.owner_id, 1, o.file_size or 0)
+    return o
+
+
+def save_object(o: Objects, old_size: int):
+    """
+    保存覆盖后的文件对象记录，按文件大小的变化更新用量
+    """
+    with transaction.atomic():
+        o.save()
+        if o.type == 'f':
+            update_usage(o.bucket, o.owner_id, 0, (o.file_size or 0) - (old_size or 0))
+
+
+def delete_object(o: Objects):
+    """
+    删除文件对象记录并更新用量
+    """
+    with transaction.atomic():
+        o.delete()
+        if o.type == 'f':
+            update_usage(o.bucket, o.owner_id, -1, -(o.file_size or 0))
+
+
+def delete_bucket(bucket: Buckets):
+    """
+    删除桶记录(级联删除文件对象)，并从用户与区域的用量中减去该桶的用量
+    """
+    with transaction.atomic():
+        owners = Objects.objects.filter(bucket=bucket, type='f').values('owner_id').annotate(
+            count=Count('obj_id'), size=Sum('file_size')
+        )
+        for i in owners:
+            if i['owner_id'] is not None:
+                ObjectUsage.objects.filter(scope='u', scope_id=i['owner_id']).update(
+                    object_count=F('object_count') - i['count'], file_size=F('file_size') - (i['size'] or 0)
+                )
+        try:
+            usage = ObjectUsage.objects.get(scope='b', scope_id=bucket.bucket_id)
+        except ObjectUsage.DoesNotExist:
+            pass
+        else:
+            ObjectUsage.objects.filter(scope='r', scope_id=bucket.bucket_region_id).update(
+                object_count=F('object_count') - usage.object_count, file_size=F('file_size') - usage.file_size
+            )
+            usage.delete()
+        bucket.delete()
+
+
+def delete_region(region: BucketRegion):
+    """
+    删除区域记录(级联删除桶与文件对象)，区域中的桶逐个通过delete_bucket删除，最后删除区域的用量
+    """
+    with transaction.atomic():
+        for bucket in Buckets.objects.filter(bucket_region=region):
+            delete_bucket(bucket)
+        ObjectUsage.objects.filter(scope='r', scope_id=region.reg_id).delete()
+        region.delete()
+
+
+def delete_user(user: User):
+    """
+    删除用户记录(级联删除桶与文件对象)，先通过delete_bucket删除用户的桶，
+    再从其它桶与区域的用量中减去该用户在其它用户的桶中上传的文件，最后删除用户的用量
+    """
+    with transaction.atomic():
+        for bucket in Buckets.objects.filter(user=user):
+            delete_bucket(bucket)
+
+        files = Objects.objects.filter(owner=user, type='f').values('bucket_id', 'bucket__bucket_region_id').annotate(
+            count=Count('obj_id'), size=Sum('file_size')
+        )
+        for i in files:
+            for scope, scope_id in (('b', i['bucket_id']), ('r', i['bucket__bucket_region_id'])):
+                if scope_id is None:
+                    continue
+                ObjectUsage.objects.filter(scope=scope, scope_id=scope_id).update(
+                    object_count=F('object_count') - i['count'], file_size=F('file_size') - (i['size'] or 0)
+                )
+        ObjectUsage.objects.filter(scope='u', scope_id=user.id).delete()
+        user.delete()
+
+
+def get_usage(scope: str, scope_id: int) -> dict:
+    try:
+        return ObjectUsage.objects.get(scope=scope, scope_id=scope_id).json
+    except ObjectUsage.DoesNotExist:
+        return {'scope': scope, 'scope_id': scope_id, 'object_count': 0, 'file_size': 0}
+
+
+def rebuild_usage() -> int:
+    """
+    根据文件对象记录重新统计所有的用量，用于修复用量与实际数据的偏差，返回用量记录的数量
+    """
+    with transaction.atomic():
+        records = []
+        files = Objects.objects.filter(type='f')
+        for scope, field in (('b', 'bucket_id'), ('u', 'owner_id'), ('r', 'bucket__bucket_region_id')):
+            for i in files.values(field).annotate(count=Count('obj_id'), size=Sum('file_size')):
+                if i[field] is None:
+                    continue
+                records.append(ObjectUsage(
+                    scope=scope, scope_id=i[field], object_count=i['count'], file_size=i['size'] or 0
+                ))
+        ObjectUsage.objects.all().delete()
+        ObjectUsage.objects.bulk_create(records, batch_size=1000)
+    return len(records)
+
+
+def get_request_size(request):
+    """
+    从请求头中获取请求体的大小，分块传输等没有Content-Length的请求返回None
+    """
+    try:
+        size = int(request.META.get('CONTENT_LENGTH') or -1)
+    except ValueError:
+        return None
+    return size if size >= 0 else None
+
+
+def _reservation_index_key(user_id: int) -> str:
+    return 'usage_reservations_%s' % user_id
+
+
+def _reservation_key(upload_id: str) -> str:
+    return '%s_reserved' % upload_id
+
+
+def _update_reservation_index(user_id: int, add: str = None, remove: str = None):
+    """
+    修改用户正在进行的分段上传id列表，同时清除预留已经失效的上传id，使用缓存中的锁保证并发修改不丢失
+    """
+    lock_key = 'usage_reservations_lock_%s' % user_id
+    for _ in range(100):
+        if cache.add(lock_key, 1, 5):
+            break
+        time.sleep(0.01)
+    else:
+        raise ParseError('reserve capacity failed, please try again later')
+
+    try:
+        key = _reservation_index_key(user_id)
+        ids = [i for i in cache.get(key, []) if i != remove]
+        alive = cache.get_many([_reservation_key(i) for i in ids])
+        ids = [i for i in ids if _reservation_key(i) in alive]
+        if add:
+            ids.append(add)
+        cache.set(key, ids, None)
+    finally:
+        cache.delete(lock_key)
+
+
+def get_reserved_capacity(user_id: int, exclude: str = None) -> int:
+    """
+    汇总用户所有分段上传预留的容量，exclude为不计算在内的上传id
+    """
+    try:
+        ids = [i for i in cache.get(_reservation_index_key(user_id), []) if i != exclude]
+        return sum(cache.get_many([_reservation_key(i) for i in ids]).values())
+    except Exception as e:
+        settings.LOGGER.error('get reserved capacity failed: %s' % e)
+        return 0
+
+
+def get_user_capacity(user: User) -> int:
+    try:
+        return CapacityQuota.objects.values_list('capacity', flat=True).get(user_id=user.id) * 1024 ** 3
+    except CapacityQuota.DoesNotExist:
+        raise ParseError('user capacity not enough')
+
+
+def verify_user_capacity(user: User, size: int, upload_id: str = None):
+    """
+    上传前验证用户的剩余容量，已用容量加上其它上传预留的容量与本次上传的大小超过配额时拒绝上传，
+    upload_id为本次分段上传的id，其预留的容量不重复计算，size未知时不验证，由ceph的用户配额限制
+    """
+    if size is None:
+        return
+    used = get_usage('u', user.id)['file_size'] + get_reserved_capacity(user.id, exclude=upload_id)
+    if used + size > get_user_capacity(user):
+        raise ParseError('user capacity not enough')
+
+
+def reserve_capacity(user: User, upload_id: str, size: int):
+    """
+    为分段上传预留容量
+
+    先写入本次上传的预留再汇总验证，并发的预留都能看到彼此，不会同时通过验证而超出配额，
+    验证失败时撤销预留。每个上传的预留单独保存，上传分段时刷新有效期，完成或者取消上传后释放
+    """
+    if not size:
+        return
+    cache.set(_reservation_key(upload_id), size, settings.UPLOAD_RESERVATION_TTL)
+    _update_reservation_index(user.id, add=upload_id)
+    if get_usage('u', user.id)['file_size'] + get_reserved_capacity(user.id) > get_user_capacity(user):
+        release_capacity(user.id, upload_id)
+        raise ParseError('user capacity not enough')
+
+
+@contextmanager
+def request_reservation(user: User, size: int):
+    """
+    为单个请求上传的请求体预留容量，请求处理完成(文件对象已计入用量)后释放，
+    并发的上传与分段上传一样不能同时占用剩余的容量
+    """
+    upload_id = 'request_%s' % uuid4().hex
+    reserve_capacity(user, upload_id, size)
+    try:
+        yield upload_id
+    finally:
+        release_capacity(user.id, upload_id)
+
+
+def get_upload_reservation(upload_id: str) -> int:
+    return cache.get(_reservation_key(upload_id), 0)
+
+
+def refresh_capacity(upload_id: str):
+    cache.touch(_reservation_key(upload_id), settings.UPLOAD_RESERVATION_TTL)
+
+
+def release_capacity(user_id: int, upload_id: str):
+    try:
+        if cache.get(_reservation_key(upload_id)) is None:
+            return
+        cache.delete(_reservation_key(upload_id))
+        _update_reservation_index(user_id, remove=upload_id)
+    except Exception as e:
+        settings.LOGGER.error('release capacity failed: %s' % e)
@@ -1,3 +1,396 @@
-from django.test import TestCase
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from rest_framework.exceptions import ParseError
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from buckets.models import BucketRegion, Buckets
+from common.breaker import RegionUnavailable
+from objects import objects_object, objects_usage
+from objects.models import ObjectUsage
+from objects.objects_transfer import MultipartUploader, RangeNotSatisfiable, parse_range_header
+from objects.objects_usage import (
+    create_object, save_object, delete_object, delete_bucket, delete_region, delete_user, get_usage, rebuild_usage,
+    reserve_capacity, release_capacity, get_reserved_capacity
+)
+from user.models import CapacityQuota, Profile
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+GB = 1024 ** 3
+
+
+class FakeS3Client:
+    """
+    只记录调用的s3客户端
+    """
+
+    def __init__(self, fail_part: int = None):
+        self.calls = []
+        self.uploads = 0
+        self.fail_part = fail_part
+        self.parts = {}
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.calls.append(('create_multipart_upload', Key))
+        self.uploads += 1
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': 'upload-%s' % self.uploads}
+
+    def upload_part(self, Body, Bucket, ContentLength, Key, UploadId, PartNumber):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        # 前面的分段上传得更慢，使分段乱序完成
+        time.sleep(0.01 / PartNumber)
+        with self._lock:
+            self.running -= 1
+        if PartNumber == self.fail_part:
+            raise IOError('upload part %s failed' % PartNumber)
+        self.parts[PartNumber] = Body
+        return {'ETag': '"%s"' % hashlib.md5(Body).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append(('complete_multipart_upload', UploadId))
+        return MultipartUpload
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append(('abort_multipart_upload', UploadId))
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append(('put_object', Key))
+        return {'ETag': '"%s"' % hashlib.md5(Body).hexdigest()}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        self.calls.append(('generate_presigned_url', Params['Key']))
+        return 'http://127.0.0.1/%s/%s?signature=x' % (Params['Bucket'], Params['Key'])
+
+
+class ParseRangeHeaderTest(SimpleTestCase):
+
+    def test_single_range(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range_header('bytes=100-', 1000), (100, 999))
+        # 结束位置超出对象大小时截断
+        self.assertEqual(parse_range_header('bytes=10-5000', 1000), (10, 999))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_range_header('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range_header('bytes=-5000', 1000), (0, 999))
+
+    def test_suffix_zero(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range_header('bytes=-0', 1000)
+
+    def test_start_past_eof(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range_header('bytes=1000-', 1000)
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range_header('bytes=0-', 0)
+
+    def test_full_response(self):
+        # 多个区间、格式不合法的区间按完整对象响应
+        self.assertIsNone(parse_range_header('bytes=0-1,5-6', 1000))
+        self.assertIsNone(parse_range_header('bytes=5-2', 1000))
+        self.assertIsNone(parse_range_header('bytes=a-b', 1000))
+        self.assertIsNone(parse_range_header('items=0-1', 1000))
+        self.assertIsNone(parse_range_header(None, 1000))
+
+
+class MultipartUploaderTest(SimpleTestCase):
+
+    def upload(self, s3, chunks: list):
+        uploader = MultipartUploader(s3, 'test', 'a.bin', workers=3, max_buffer=3).start()
+        try:
+            for chunk in chunks:
+                uploader.add_part(chunk)
+            return uploader, uploader.complete()
+        except Exception:
+            uploader.abort()
+            raise
+
+    def test_parts_in_order(self):
+        s3 = FakeS3Client()
+        chunks = [bytes([i]) * 100 for i in range(10)]
+        uploader, completed = self.upload(s3, chunks)
+        self.assertEqual([i['PartNumber'] for i in completed['Parts']], list(range(1, 11)))
+        self.assertEqual(completed['Parts'][0]['ETag'], hashlib.md5(chunks[0]).hexdigest())
+        self.assertEqual(b''.join(s3.parts[i] for i in range(1, 11)), b''.join(chunks))
+        self.assertEqual(uploader.md5.hexdigest(), hashlib.md5(b''.join(chunks)).hexdigest())
+        self.assertEqual(uploader.size, 1000)
+        # 同时上传的分段数量不超过线程数
+        self.assertLessEqual(s3.max_running, 3)
+        self.assertGreater(s3.max_running, 1)
+
+    def test_empty_file(self):
+        s3 = FakeS3Client()
+        _, completed = self.upload(s3, [])
+        self.assertEqual(len(completed['Parts']), 1)
+        self.assertEqual(s3.parts[1], b'')
+
+    def test_part_failed(self):
+        s3 = FakeS3Client(fail_part=2)
+        with self.assertRaises(IOError):
+            self.upload(s3, [b'a' * 100 for _ in range(6)])
+        self.assertIn(('abort_multipart_upload', 'upload-1'), s3.calls)
+        self.assertNotIn(('complete_multipart_upload', 'upload-1'), s3.calls)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ObjectUsageTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.region = BucketRegion.objects.create(name='test', server='http://127.0.0.1', type='local')
+        self.user = User.objects.create(username='usage_test')
+        self.bucket = Buckets.objects.create(name='usage-test', user=self.user, bucket_region=self.region)
+
+    def create_file(self, key: str, size: int):
+        return create_object(
+            self.bucket, name=key, key=key, type='f', root='', file_size=size, owner=self.user
+        )
+
+    def assertUsage(self, count: int, size: int):
+        for scope, scope_id in (('b', self.bucket.bucket_id), ('u', self.user.id), ('r', self.region.reg_id)):
+            usage = get_usage(scope, scope_id)
+            self.assertEqual((usage['object_count'], usage['file_size']), (count, size), scope)
+
+    def assertRebuildMatches(self):
+        # 重新统计时不生成用量为0的记录
+        rows = ObjectUsage.objects.exclude(object_count=0, file_size=0)
+        ledger = set(rows.values_list('scope', 'scope_id', 'object_count', 'file_size'))
+        rebuild_usage()
+        self.assertEqual(ledger, set(rows.values_list('scope', 'scope_id', 'object_count', 'file_size')))
+
+    def test_create(self):
+        self.create_file('a.txt', 100)
+        self.create_file('b.txt', 50)
+        # 目录不计入用量
+        create_object(self.bucket, name='dir', key='dir/', type='d', root='', owner=self.user)
+        self.assertUsage(2, 150)
+        self.assertRebuildMatches()
+
+    def test_overwrite(self):
+        o = self.create_file('a.txt', 100)
+        old_size = o.file_size
+        o.file_size = 30
+        save_object(o, old_size)
+        self.assertUsage(1, 30)
+        self.assertRebuildMatches()
+
+    def test_delete(self):
+        o = self.create_file('a.txt', 100)
+        self.create_file('b.txt', 50)
+        delete_object(o)
+        self.assertUsage(1, 50)
+        self.assertRebuildMatches()
+
+    def test_delete_bucket(self):
+        self.create_file('a.txt', 100)
+        delete_bucket(self.bucket)
+        self.assertUsage(0, 0)
+        self.assertRebuildMatches()
+
+    def test_delete_user(self):
+        # 用户在其它用户的桶中上传的文件也要从该桶与区域的用量中减去
+        Profile.objects.filter(user=self.user).update(phone='1')
+        other = User.objects.create(username='usage_other')
+        other_bucket = Buckets.objects.create(name='usage-other', user=other, bucket_region=self.region)
+        self.create_file('a.txt', 100)
+        create_object(other_bucket, name='b.txt', key='b.txt', type='f', root='', file_size=50, owner=self.user)
+        create_object(other_bucket, name='c.txt', key='c.txt', type='f', root='', file_size=20, owner=other)
+        delete_user(self.user)
+        self.assertEqual(get_usage('b', other_bucket.bucket_id)['file_size'], 20)
+        self.assertEqual(get_usage('r', self.region.reg_id)['file_size'], 20)
+        self.assertRebuildMatches()
+
+    def test_delete_region(self):
+        self.create_file('a.txt', 100)
+        delete_region(self.region)
+        self.assertUsage(0, 0)
+        self.assertFalse(ObjectUsage.objects.filter(scope='r', scope_id=self.region.reg_id).exists())
+        self.assertRebuildMatches()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CapacityReservationTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.region = BucketRegion.objects.create(name='test', server='http://127.0.0.1', type='local')
+        self.user = User.objects.create(username='reserve_test')
+        CapacityQuota.objects.filter(user=self.user).update(capacity=1)
+        self.bucket = Buckets.objects.create(name='reserve-test', user=self.user, bucket_region=self.region)
+
+    def test_reject_over_quota(self):
+        reserve_capacity(self.user, 'upload-1', int(0.75 * GB))
+        with self.assertRaises(ParseError):
+            reserve_capacity(self.user, 'upload-2', int(0.75 * GB))
+        # 被拒绝的上传不保留预留
+        self.assertEqual(get_reserved_capacity(self.user.id), int(0.75 * GB))
+
+        release_capacity(self.user.id, 'upload-1')
+        reserve_capacity(self.user, 'upload-2', int(0.75 * GB))
+        self.assertEqual(get_reserved_capacity(self.user.id), int(0.75 * GB))
+
+    def test_concurrent_reservations(self):
+        # 第二个上传在第一个上传写入预留之后、验证之前到达，两个上传不能同时通过验证
+        get_user_capacity = objects_usage.get_user_capacity
+        rejected = []
+
+        def reserve(upload_id: str):
+            try:
+                reserve_capacity(self.user, upload_id, int(0.75 * GB))
+            except ParseError:
+                rejected.append(upload_id)
+
+        def interleave(user):
+            if interleave.first:
+                interleave.first = False
+                reserve('upload-2')
+            return get_user_capacity(user)
+        interleave.first = True
+
+        with mock.patch.object(objects_usage, 'get_user_capacity', side_effect=interleave):
+            reserve('upload-1')
+
+        self.assertEqual(len(rejected), 1)
+        self.assertLessEqual(get_reserved_capacity(self.user.id), GB)
+
+    def init_multipart_upload(self, s3, size: int):
+        data = {'bucket_name': self.bucket.name, 'key': 'big.bin', 'size': str(size)}
+        request = APIRequestFactory().post('/api/objects/init_multipart_upload', data)
+        with mock.patch.object(objects_object, 'validate_license_expire'), \
+                mock.patch.object(objects_object, 'verify_bucket_owner_and_permission'), \
+                mock.patch.object(objects_object, 's3_client', return_value=s3):
+            return objects_object.init_multipart_upload_endpoint(request)
+
+    def test_init_multipart_upload_rejected(self):
+        s3 = FakeS3Client()
+        self.assertEqual(self.init_multipart_upload(s3, int(0.75 * GB)).status_code, 200)
+        # 剩余容量不足时不在后端创建分段上传
+        self.assertEqual(self.init_multipart_upload(s3, int(0.75 * GB)).status_code, 400)
+        self.assertEqual(s3.calls, [('create_multipart_upload', 'big.bin')])
+
+    def test_init_multipart_upload_aborted(self):
+        s3 = FakeS3Client()
+        self.assertEqual(self.init_multipart_upload(s3, int(0.75 * GB)).status_code, 200)
+        # 并发的上传同时通过了上传前的验证，预留容量失败的上传在后端被取消
+        with mock.patch.object(objects_object, 'verify_user_capacity'):
+            self.assertEqual(self.init_multipart_upload(s3, int(0.75 * GB)).status_code, 400)
+        self.assertIn(('abort_multipart_upload', 'upload-2'), s3.calls)
+        self.assertIsNone(cache.get('upload-2'))
+        self.assertEqual(get_reserved_capacity(self.user.id), int(0.75 * GB))
+
+    def test_put_object_reserved(self):
+        # 写入后端期间请求体的大小计入预留容量，文件对象计入用量后释放
+        s3 = FakeS3Client()
+        reserved = []
+        put_object = s3.put_object
+
+        def record(**kwargs):
+            reserved.append(get_reserved_capacity(self.user.id))
+            return put_object(**kwargs)
+        s3.put_object = record
+
+        request = APIRequestFactory().put(
+            '/api/objects/put_object?bucket_name=%s&key=a.bin' % self.bucket.name,
+            b'x' * 100, content_type='application/octet-stream'
+        )
+        with mock.patch.object(objects_object, 'validate_license_expire'), \
+                mock.patch.object(objects_object, 'verify_bucket_owner_and_permission'), \
+                mock.patch.object(objects_object, 's3_client', return_value=s3):
+            response = objects_object.put_object_to_bucket_endpoint(request)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(reserved, [100])
+        self.assertEqual(get_reserved_capacity(self.user.id), 0)
+        self.assertEqual(get_usage('u', self.user.id)['file_size'], 100)
+
+    def test_form_upload_rejected_before_parsing(self):
+        # 超出容量的表单上传在解析请求体之前被拒绝
+        request = APIRequestFactory().put(
+            '/api/objects/upload_file', b'', content_type='multipart/form-data; boundary=x',
+            CONTENT_LENGTH=str(2 * GB)
+        )
+        force_authenticate(request, user=self.user)
+        with mock.patch.object(objects_object, 'validate_license_expire'):
+            response = objects_object.upload_file_to_bucket_endpoint(request)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['detail'], 'user capacity not enough')
+        self.assertFalse(hasattr(request, '_files'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, BANDWIDTH_LIMITER='local', DOWNLOAD_URL_REDIRECT=False)
+class DownloadOffloadTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.region = BucketRegion.objects.create(name='test', server='http://127.0.0.1', type='local')
+        self.user = User.objects.create(username='offload_test')
+        self.bucket = Buckets.objects.create(name='offload-test', user=self.user, bucket_region=self.region)
+        self.obj = create_object(
+            self.bucket, name='a.bin', key='a.bin', type='f', root='', file_size=4, etag='etag', owner=self.user
+        )
+        # 匿名用户按USER_MIN_BANDWIDTH限速
+        cache.set('token', (self.obj, AnonymousUser()), 300)
+        self.s3 = FakeS3Client()
+
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, b'data')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def download(self, cached: bool = True):
+        with mock.patch.object(objects_object, 's3_client', return_value=self.s3), \
+                mock.patch.object(objects_object.OBJECT_CACHE, 'open',
+                                  side_effect=lambda *args: open(self.path, 'rb') if cached else None):
+            res = objects_object.download_file_from_url(RequestFactory().get('/download_by_token/token'), 'token')
+        self.addCleanup(res.close)
+        return res
+
+    @override_settings(DOWNLOAD_OFFLOAD='x-sendfile', UNSHAPED_BANDWIDTH=4)
+    def test_x_sendfile_unshaped(self):
+        res = self.download()
+        self.assertEqual(res['X-Sendfile'], os.path.abspath(self.path))
+
+    @override_settings(DOWNLOAD_OFFLOAD='x-accel-redirect', UNSHAPED_BANDWIDTH=4)
+    def test_x_accel_redirect_miss_unshaped(self):
+        res = self.download(cached=False)
+        self.assertTrue(res['X-Accel-Redirect'].startswith('/internal/proxy/http/127.0.0.1/offload-test/a.bin'))
+
+    @override_settings(DOWNLOAD_OFFLOAD='x-sendfile', UNSHAPED_BANDWIDTH=None)
+    def test_shaped_not_offloaded(self):
+        # 限速用户的下载由worker限速转发
+        res = self.download()
+        self.assertFalse(res.has_header('X-Sendfile'))
+        self.assertEqual(b''.join(res.streaming_content), b'data')
+
+    @override_settings(DOWNLOAD_URL_REDIRECT=True, UNSHAPED_BANDWIDTH=4)
+    def test_redirect_unshaped(self):
+        res = self.download()
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res['Location'], 'http://127.0.0.1/offload-test/a.bin?signature=x')
+
+    @override_settings(DOWNLOAD_URL_REDIRECT=True, UNSHAPED_BANDWIDTH=None)
+    def test_redirect_shaped(self):
+        # 限速用户不重定向，仍由worker限速转发
+        res = self.download()
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(('generate_presigned_url', 'a.bin'), self.s3.calls)
+
+    def test_region_unavailable(self):
+        breaker = mock.Mock()
+        breaker.check.side_effect = RegionUnavailable()
+        with mock.patch.object(objects_object, 'get_breaker', return_value=breaker):
+            res = self.download(cached=False)
+        self.assertEqual(res.status_code, 503)
@@ -1,11 +1,14 @@
+import atexit
 import json
 import logging
+import queue
 import time
 from logging import handlers
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import MD5
 import base64
+import fcntl
 import os
 import threading
 
@@ -19,18 +22,93 @@ xSYTnXdcXEwWWjrzXN+mB07nDYJP3q693UMiaZkyjNkQEv+I1FmlkgAzsqnsID74LS43HGq
 FODLy7eKFro0yUrJR62fzwxg+HCG07Hmo+h++8ers56PO6f1Ghe4EDNlUHvZWjcOeGuzu8=
 '''
 
-lock = threading.Lock()
+class LicenseClock:
+    """
+    授权时钟
 
+    启动时以保存的检查点与本地时间中较大的值为基准，之后按单调时间递增，不受修改本地时间的影响。
+    各进程从内存中读取时钟，只有持有文件锁的一个进程每隔interval秒将时钟作为检查点写入文件，
+    重启后本地时间早于检查点说明本地时间被修改过
+    """
 
-def validate_local_time():
-    clock = get_clock()
-    if 0 <= time.time() < clock:
-        return False
+    def __init__(self, path: str, interval: int = 60):
+        self.path = path
+        self.interval = interval
+        self.base = -1
+        self.monotonic_base = 0
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def init(self) -> bool:
+        """
+        本地时间早于检查点时返回False
+        """
+        checkpoint = get_clock(self.path)
+        now = time.time()
+        if 0 <= now < checkpoint:
+            return False
+        self.base = int(now)
+        self.monotonic_base = time.monotonic()
+        self.checkpoint()
+        return True
+
+    def now(self) -> int:
+        if self.base >= 0 and self._pid != os.getpid():
+            self.start()
+        return self.value()
+
+    def value(self) -> int:
+        if self.base < 0:
+            return -1
+        return int(self.base + time.monotonic() - self.monotonic_base)
+
+    def start(self):
+        """
+        在当前进程中启动写入检查点的后台线程，uwsgi fork出的worker各自启动
+        """
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        t = threading.Thread(target=self._run, args=())
+        t.setDaemon(True)
+        t.start()
+
+    def _run(self):
+        lock_fp = open(self.path + '.lock', 'a')
+        locked = False
+        while True:
+            time.sleep(self.interval)
+            if not locked:
+                # 文件锁在进程退出后自动释放，其它进程的线程可以接替写入
+                try:
+                    fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                locked = True
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        写入检查点，不覆盖更大的检查点
+        """
+        now = self.value()
+        if now <= get_clock(self.path):
+            return
+        tmp_file = '%s.%s' % (self.path, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as fp:
+                fp.write(str(now).encode())
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            print('write clock checkpoint failed: %s' % e)
 
-    t = threading.Thread(target=write_clock, args=())
-    t.setDaemon(True)
-    t.start()
-    return True
+
+CLOCK = LicenseClock(os.path.dirname(__file__) + '/clock.dat')
+
+
+def validate_local_time():
+    return CLOCK.init()
 
 
 def get_license():
@@ -84,7 +162,109 @@ def verify(signature: str, data: str):
     return verifier.verify(h, base64.b64decode(signature))
 
 
-def get_logger() -> logging.Logger:
+class AsyncLogHandler(logging.Handler):
+    """
+    异步日志处理器
+
+    请求线程只将日志记录放入有界队列，由每个进程中的后台线程批量格式化并写入文件，
+    队列已满时丢弃日志并计数，不阻塞请求。后台线程在进程中第一次记录日志时启动，
+    uwsgi fork出的worker各自启动自己的写入线程
+    """
+
+    def __init__(self, target: handlers.TimedRotatingFileHandler, queue_size: int = 10000, batch_size: int = 256):
+        super().__init__()
+        self.target = target
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # fork之后队列中可能残留父进程的日志，使用新的队列
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            t = threading.Thread(target=self._run, args=())
+            t.setDaemon(True)
+            t.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        q = self.queue
+        while True:
+            records = [q.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(records)
+
+    def _write(self, records: list):
+        th = self.target
+        if self.dropped > self._reported_dropped:
+            records.append(logging.makeLogRecord({
+                'msg': 'log queue is full, dropped %s log records' % (self.dropped - self._reported_dropped),
+                'levelname': 'WARNING',
+                'levelno': logging.WARNING,
+            }))
+            self._reported_dropped = self.dropped
+
+        th.acquire()
+        try:
+            # django配置日志时会关闭已有的处理器，与FileHandler.emit一样重新打开文件
+            if th.stream is None:
+                th.stream = th._open()
+            for record in records:
+                try:
+                    if th.shouldRollover(record):
+                        th.doRollover()
+                    th.stream.write(th.format(record) + th.terminator)
+                except Exception:
+                    th.handleError(record)
+            th.stream.flush()
+        finally:
+            th.release()
+
+    def flush(self):
+        """
+        将队列中剩余的日志写入文件，进程退出时调用
+        """
+        records = []
+        while True:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if records:
+            self._write(records)
+
+
+class LazyJson:
+    """
+    日志消息中的json在写入线程中才序列化
+    """
+
+    def __init__(self, data: dict):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, ensure_ascii=False, default=str)[1:-1].replace('"', '')
+
+
+def get_logger(queue_size: int = 10000, batch_size: int = 256) -> logging.Logger:
     if not os.path.isdir('./logs') or not os.path.exists('./logs'):
         os.mkdir('./logs')
     logger = logging.getLogger(__name__)
@@ -94,15 +274,15 @@ def get_logger() -> logging.Logger:
     th.setFormatter(log_fmt)
     th.suffix = '%Y%m%d.log'
     logger.setLevel(logging.INFO)
-    logger.addHandler(th)
+    logger.addHandler(AsyncLogHandler(th, queue_size, batch_size))
     return logger
 
 
-def get_clock() -> int:
-    if not os.path.exists('./oss/clock.dat'):
+def get_clock(path: str = './oss/clock.dat') -> int:
+    if not os.path.exists(path):
         return -1
     try:
-        with open('./oss/clock.dat', 'rb') as fp:
+        with open(path, 'rb') as fp:
             return int(fp.read().decode())
     except ValueError:
         return -1
@@ -121,15 +301,3 @@ def get_db_config() -> dict:
         return dict()
     else:
         return j
-
-
-def write_clock() -> None:
-    now = int(time.time())
-    clock_file = os.path.dirname(__file__)+'/clock.dat'
-    while True:
-        lock.acquire()
-        with open(clock_file, 'wb+') as fp:
-            fp.write(str(now).encode())
-        lock.release()
-        now += 1
-        time.sleep(1)
@@ -87,7 +87,8 @@ if arg1 == "production":
         "--auto-procname",
         # 因为python有GIL的原因，能过此选项目开启多线程
         "--enable-threads",
-        # "--offload-threads=%s" % worker,
+        # 下载数据可以交给offload线程发送，不占用worker
+        "--offload-threads=%s" % worker,
         "--processes=%s" % worker,
         "--thunder-lock",
         "--static-map=/static=%s/static" % settings.BASE_DIR,
@@ -21,7 +21,10 @@ from oss import get_db_config
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
-LOGGER = get_logger()
+# 日志队列的长度与每次批量写入的日志条数
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 256
+LOGGER = get_logger(LOG_QUEUE_SIZE, LOG_BATCH_SIZE)
 
 LICENSE_INFO = get_license()
 
@@ -58,15 +61,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'common.middleware.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    # 在CommonMiddleware之前，响应中已经设置了Content-Length
+    'common.middleware.RequestLogMiddleware',
     'django.middleware.common.CommonMiddleware',
     # 'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     # 'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'common.middleware.RequestLogMiddleware',
 ]
 
 ROOT_URLCONF = 'oss.urls'
@@ -190,7 +195,96 @@ CORS_ALLOW_HEADERS = (
     'origin',
     'user-agent',
     'x-csrftoken',
-    'x-requested-with'
+    'x-requested-with',
+    'range',
+    'if-range',
+)
+# 分段下载时浏览器端需要读取的响应头
+CORS_EXPOSE_HEADERS = (
+    'Accept-Ranges',
+    'Content-Range',
+    'Content-Length',
+    'ETag',
 )
 
 USER_MIN_BANDWIDTH = 4
+
+# 分段上传的分段大小、并发上传线程数、每个上传最多缓冲的分段数量
+UPLOAD_PART_SIZE = 5 * 1024 ** 2
+UPLOAD_CONCURRENCY = 4
+UPLOAD_MAX_BUFFERED_PARTS = 8
+# put_object请求体超过该大小时自动切换为分段上传
+PUT_OBJECT_MULTIPART_THRESHOLD = 8 * 1024 ** 2
+# 下载时每次从后端响应流中读取的字节数
+DOWNLOAD_CHUNK_SIZE = 1024 ** 2
+# 下载预读取的缓冲块数量，为0时不预读取
+DOWNLOAD_PREFETCH_DEPTH = 4
+# 下载带宽限速器，cache为通过memcached在所有进程间共享，local为进程内限速
+BANDWIDTH_LIMITER = 'cache'
+# 带宽限速允许的突发时长，单位为秒
+BANDWIDTH_LIMIT_BURST = 0.5
+# 带宽(MB/s)不小于该值的用户不限速，下载可以offload或者重定向到后端，None为所有用户都限速
+UNSHAPED_BANDWIDTH = None
+# 节点本地对象缓存的目录、总大小(为0时关闭缓存)、允许缓存的单个对象的最大大小
+OBJECT_CACHE_DIR = './cache/objects'
+OBJECT_CACHE_SIZE = 10 * 1024 ** 3
+OBJECT_CACHE_MAX_OBJECT_SIZE = 256 * 1024 ** 2
+# 下载数据的传输方式，None为由worker转发数据
+# uwsgi为本地缓存的完整对象交给uwsgi的offload线程发送，需要开启--offload-threads
+# x-sendfile为本地缓存的对象由前端代理(apache mod_xsendfile)发送
+# x-accel-redirect为交给nginx发送，本地缓存的对象重定向到DOWNLOAD_ACCEL_CACHE_PREFIX，
+# 其余对象重定向到DOWNLOAD_ACCEL_PROXY_PREFIX/<scheme>/<host>/<path>?<query>，nginx参考配置:
+#   location /internal/cache/ { internal; alias /path/to/cache/objects/; }
+#   location ~ ^/internal/proxy/(\w+)/(.*)$ { internal; proxy_pass $1://$2$is_args$args; }
+# offload的传输不受用户的带宽限速，只用于UNSHAPED_BANDWIDTH中不限速的用户，限速用户的下载仍由worker限速转发
+DOWNLOAD_OFFLOAD = None
+DOWNLOAD_ACCEL_CACHE_PREFIX = '/internal/cache/'
+DOWNLOAD_ACCEL_PROXY_PREFIX = '/internal/proxy/'
+# 下载使用的预签名链接的有效期，单位为秒
+DOWNLOAD_PRESIGNED_EXPIRE = 60
+# 下载链接是否重定向到后端的预签名链接，只对UNSHAPED_BANDWIDTH中不限速的用户生效，其余用户的下载都经过限速器
+DOWNLOAD_URL_REDIRECT = False
+# 进程内缓存的s3客户端数量与有效期，单位为秒
+S3_CLIENT_CACHE_SIZE = 256
+S3_CLIENT_CACHE_TTL = 600
+# 后台同步ceph用户与配额的间隔时间(秒，为0时不启动后台同步)与每批同步的用户数量
+CEPH_SYNC_INTERVAL = 10
+CEPH_SYNC_BATCH_SIZE = 100
+# 已确认在ceph中存在的用户账号的缓存时间，单位为秒
+CEPH_USER_CACHE_TIME = 3600
+# 区域熔断器: 耗时与失败率的加权系数、熔断的失败率阈值、开始统计的最少调用次数、熔断后半开的时间(秒)
+BREAKER_EWMA_ALPHA = 0.2
+BREAKER_ERROR_RATE = 0.5
+BREAKER_MIN_CALLS = 5
+BREAKER_RESET_TIMEOUT = 30
+# 每个ip在RATE_LIMIT_WINDOW秒内最多允许RATE_LIMIT_REQUESTS个请求，
+# 超过限制的窗口数达到RATE_LIMIT_BLOCK_TIMES后禁止访问RATE_LIMIT_BLOCK_TIME秒
+RATE_LIMIT_WINDOW = 1
+RATE_LIMIT_REQUESTS = 30
+RATE_LIMIT_BLOCK_TIMES = 2
+RATE_LIMIT_BLOCK_TIME = 7200
+# token最近访问时间的更新间隔，单位为秒
+TOKEN_TOUCH_INTERVAL = 60
+# 签名访问允许的请求时间与服务器时间的最大误差，单位为秒
+SIGNATURE_EXPIRE_TIME = 900
+# 是否允许在查询字符串中直接传递access_key与secret_key访问接口，secret_key会出现在代理与访问日志中，
+# 默认关闭，只用于旧客户端迁移到签名访问期间，将在下一个版本中移除
+ALLOW_LEGACY_KEY_AUTH = False
+# access_key索引在进程内与memcached中的缓存时间，单位为秒
+ACCESS_KEY_LOCAL_TTL = 10
+ACCESS_KEY_CACHE_TIME = 3600
+# 进程内缓存的用户数量与有效期(秒)，用户版本号在进程内的缓存时间(秒)
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 600
+USER_VERSION_TTL = 5
+# 桶与文件对象的授权索引在进程内与memcached中的缓存时间，单位为秒
+ACL_LOCAL_TTL = 5
+ACL_CACHE_TIME = 3600
+# 各进程的监控指标文件目录，为None时只输出当前进程的指标
+METRICS_DIR = './cache/metrics'
+# 各进程将监控指标写入文件的间隔时间(秒)
+METRICS_DUMP_INTERVAL = 5
+# 分段上传预留容量的有效期(秒)，每次上传分段时刷新
+UPLOAD_RESERVATION_TTL = 3600
+# 并发查询各区域用户用量的线程数
+USAGE_QUERY_WORKERS = 8
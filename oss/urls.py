@@ -19,7 +19,8 @@ from django.urls import path, include
 from common.views import (
     send_phone_verify_code_endpoint,
     build_image_verify_code_endpoint,
-    build_qrcode
+    build_qrcode,
+    query_metrics_endpoint
 )
 from objects.objects_object import download_file_from_url
 from django.shortcuts import render
@@ -41,6 +42,7 @@ urlpatterns = [
     path('api/user/send_verify_code', send_phone_verify_code_endpoint),
     path('api/captcha', build_image_verify_code_endpoint),
     path('api/qrcode', build_qrcode),
+    path('api/metrics', query_metrics_endpoint),
     path('download_by_token/<str:token>', download_file_from_url)
 ]
 # ] + static(
@@ -14,3 +14,20 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'oss.settings')
 
 application = get_wsgi_application()
+
+# uwsgi在加载应用后fork出worker，后台线程需要在每个worker中启动
+from oss import CLOCK
+from user.user_sync import start_ceph_sync
+
+
+def start_background_threads():
+    CLOCK.start()
+    start_ceph_sync()
+
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    start_background_threads()
+else:
+    postfork(start_background_threads)
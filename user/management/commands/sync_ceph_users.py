@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from user.user_sync import mark_users_unsync, sync_ceph_users
+
+
+class Command(BaseCommand):
+    help = 'create ceph users and sync user quota to all enabled ceph regions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='sync all users, not only the waiting users')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            mark_users_unsync()
+
+        total_success = total_failed = 0
+        while True:
+            success, failed = sync_ceph_users()
+            total_success += success
+            total_failed += failed
+            # 失败的用户进入重试等待，不会在本次命令中再次查询到
+            if not success and not failed:
+                break
+
+        self.stdout.write('synced: %s, failed: %s' % (total_success, total_failed))
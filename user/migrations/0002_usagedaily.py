@@ -0,0 +1,35 @@
+# Generated by Django 3.2.6 on 2026-10-18 17:53
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buckets', '0002_bucketregion_client_config'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('user', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageDaily',
+            fields=[
+                ('u_id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('date', models.DateField(verbose_name='usage date')),
+                ('get_ops', models.BigIntegerField(default=0, verbose_name='get object successful ops')),
+                ('bytes_sent', models.BigIntegerField(default=0, verbose_name='get object bytes sent')),
+                ('put_ops', models.BigIntegerField(default=0, verbose_name='put object successful ops')),
+                ('bytes_received', models.BigIntegerField(default=0, verbose_name='put object bytes received')),
+                ('create_time', models.DateTimeField(auto_now=True)),
+                ('region', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='buckets.bucketregion')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_daily', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'user_usage_daily',
+                'unique_together': {('user', 'region', 'date')},
+            },
+        ),
+    ]
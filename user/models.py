@@ -1,11 +1,14 @@
 from django.db import models
 from django.contrib.auth.models import User, Group
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 from account.models import Plan
+from buckets.models import BucketRegion
 from django.conf import settings
 from common.func import build_ceph_userinfo, random_build_str
+from common.clients import invalidate_user_clients, invalidate_user_cache
+from common.signature import invalidate_access_key
 import time
 
 
@@ -62,11 +65,15 @@ class Keys(models.Model):
         self.user_access_key = random_build_str(32)
         self.user_secret_key = random_build_str(40)
         self.save()
+        # 由后台同步线程在ceph中创建该用户
+        CapacityQuota.objects.filter(user=self.user).update(sync=1)
 
     def change_user_key(self):
+        old_access_key = self.user_access_key
         self.user_access_key = random_build_str(32)
         self.user_secret_key = random_build_str(40)
         self.save()
+        invalidate_access_key(old_access_key)
 
     def set_allow_access(self, ip: str):
         if ip == '0.0.0.0':
@@ -74,6 +81,7 @@ class Keys(models.Model):
         else:
             self.allow_ip = ip
         self.save()
+        invalidate_access_key(self.user_access_key)
 
 
 class CapacityQuota(models.Model):
@@ -114,12 +122,14 @@ class CapacityQuota(models.Model):
             self.start_time = time.time()
             self.duration = self.duration
         self.capacity = cap
+        # 由后台同步线程将新的容量同步到ceph
+        self.sync = 1
         self.save()
         return self.json
 
     def ceph_sync(self):
         self.sync = 0
-        self.save()
+        self.save(update_fields=['sync'])
 
     @property
     def json(self):
@@ -181,6 +191,43 @@ class BandwidthQuota(models.Model):
         }
 
 
+class UsageDaily(models.Model):
+    """
+    用户在各区域每天的请求数与流量，只保存已经结束的日期，当天的数据实时从rgw查询
+    """
+    u_id = models.AutoField(primary_key=True, auto_created=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='usage_daily')
+    region = models.ForeignKey(BucketRegion, on_delete=models.CASCADE)
+    date = models.DateField(verbose_name='usage date', blank=False)
+    get_ops = models.BigIntegerField(verbose_name='get object successful ops', default=0)
+    bytes_sent = models.BigIntegerField(verbose_name='get object bytes sent', default=0)
+    put_ops = models.BigIntegerField(verbose_name='put object successful ops', default=0)
+    bytes_received = models.BigIntegerField(verbose_name='put object bytes received', default=0)
+    create_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'user_usage_daily'
+        unique_together = (
+            'user', 'region', 'date'
+        )
+
+    def __str__(self):
+        return f'{self.user_id}, {self.region_id}, {self.date}'
+
+    @property
+    def json(self):
+        return {
+            'get_obj': {
+                'successful_ops': self.get_ops,
+                'bytes_sent': self.bytes_sent,
+            },
+            'put_obj': {
+                'successful_ops': self.put_ops,
+                'bytes_received': self.bytes_received,
+            },
+        }
+
+
 class DefaultGroup(models.Model):
     group = models.OneToOneField(Group, on_delete=models.CASCADE, related_name='default_group')
     default = models.BooleanField(verbose_name="whether user default role", default=False)
@@ -206,3 +253,43 @@ def handle_create_user(sender, instance, created, **kwargs):
         Profile.objects.create(user=instance)
         Token.objects.create(user=instance)
 
+
+
+@receiver([post_save, post_delete], sender=Profile)
+@receiver([post_save, post_delete], sender=Keys)
+@receiver([post_save, post_delete], sender=CapacityQuota)
+def handle_user_client_change(sender, instance, **kwargs):
+    # 只修改后端同步标志时，不需要重新创建客户端
+    update_fields = kwargs.get('update_fields', None)
+    if update_fields and set(update_fields) == {'sync'}:
+        return
+    invalidate_user_clients(instance.user.username)
+
+
+@receiver(post_save, sender=User)
+def handle_user_access_key_change(sender, instance, created, **kwargs):
+    # 用户被禁用后，access_key的索引需要重新加载，登陆时只更新最近登陆时间，不需要重新加载
+    update_fields = kwargs.get('update_fields', None)
+    if created or not hasattr(instance, 'keys') or (update_fields and set(update_fields) == {'last_login'}):
+        return
+    invalidate_access_key(instance.keys.user_access_key)
+
+
+@receiver([post_save, post_delete], sender=Profile)
+@receiver([post_save, post_delete], sender=Keys)
+@receiver([post_save, post_delete], sender=CapacityQuota)
+@receiver([post_save, post_delete], sender=BandwidthQuota)
+def handle_user_info_change(sender, instance, **kwargs):
+    update_fields = kwargs.get('update_fields', None)
+    if update_fields and set(update_fields) == {'sync'}:
+        return
+    invalidate_user_cache(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=User)
+def handle_user_change(sender, instance, **kwargs):
+    # 登陆时只更新最近登陆时间，不需要使缓存的用户失效
+    update_fields = kwargs.get('update_fields', None)
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    invalidate_user_cache(instance.pk)
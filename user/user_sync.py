@@ -0,0 +1,107 @@
+import os
+import socket
+import threading
+import time
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from buckets.models import BucketRegion
+from common.func import rgw_client, provision_ceph_user
+from .models import CapacityQuota
+
+# 同步失败的用户下次重试的时间与失败次数，{user_id: (next_time, failures)}
+_retry = dict()
+_started_pid = None
+_start_lock = threading.Lock()
+
+
+def mark_users_unsync(user_id: int = None):
+    """
+    将用户标记为等待同步，不指定用户时标记所有已生成ceph账号的用户，用于新增或者修改区域
+    """
+    query = CapacityQuota.objects.all()
+    if user_id:
+        query = query.filter(user_id=user_id)
+    else:
+        query = query.exclude(user__keys__ceph_uid='')
+    query.update(sync=1)
+
+
+def sync_ceph_users(batch_size: int = None) -> tuple:
+    """
+    同步一批等待同步的用户，在所有启用的ceph区域中创建用户并同步配额
+
+    全部区域同步成功的用户清除同步标志，失败的用户按指数退避重试，返回(成功数量, 失败数量)
+    """
+    batch_size = batch_size if batch_size else settings.CEPH_SYNC_BATCH_SIZE
+    now = time.time()
+    waiting = [k for k, v in _retry.items() if v[0] > now]
+
+    users = User.objects.select_related('capacity_quota').select_related('keys').filter(
+        capacity_quota__sync=1
+    ).exclude(keys__ceph_uid='').exclude(pk__in=waiting).order_by('pk')[:batch_size]
+    if not users:
+        return 0, 0
+
+    regions = BucketRegion.objects.filter(type='local', state='e')
+    clients = [rgw_client(i.reg_id) for i in regions]
+
+    success = failed = 0
+    for u in users:
+        try:
+            for rgw in clients:
+                provision_ceph_user(rgw, u)
+        except Exception as e:
+            failures = _retry[u.pk][1] + 1 if u.pk in _retry else 1
+            delay = min(settings.CEPH_SYNC_INTERVAL * 2 ** failures, 3600)
+            _retry[u.pk] = (time.time() + delay, failures)
+            settings.LOGGER.error('sync ceph user %s failed %s times: %s' % (u.username, failures, e))
+            failed += 1
+            continue
+
+        _retry.pop(u.pk, None)
+        # 同步期间容量被修改的用户保留同步标志，下一轮重新同步
+        CapacityQuota.objects.filter(
+            pk=u.capacity_quota.pk, capacity=u.capacity_quota.capacity
+        ).update(sync=0)
+        success += 1
+    return success, failed
+
+
+def ceph_sync_loop():
+    lock_key = 'ceph_sync_lock'
+    # 不同主机上的进程id可能相同，使用主机名、进程id与随机值作为锁的持有者
+    token = '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid4())
+    while True:
+        try:
+            # 多个进程中只有持有锁的进程执行同步
+            if cache.add(lock_key, token, settings.CEPH_SYNC_INTERVAL * 3) or cache.get(lock_key) == token:
+                cache.set(lock_key, token, settings.CEPH_SYNC_INTERVAL * 3)
+                # 一批全部成功时继续同步下一批
+                while sync_ceph_users() == (settings.CEPH_SYNC_BATCH_SIZE, 0):
+                    pass
+        except Exception as e:
+            settings.LOGGER.error('ceph sync error: %s' % e)
+        finally:
+            close_old_connections()
+        time.sleep(settings.CEPH_SYNC_INTERVAL)
+
+
+def start_ceph_sync():
+    """
+    在当前进程中启动后台同步线程，每个进程只启动一次
+    """
+    global _started_pid
+    if settings.CEPH_SYNC_INTERVAL <= 0:
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+    t = threading.Thread(target=ceph_sync_loop, args=())
+    t.setDaemon(True)
+    t.start()
@@ -0,0 +1,116 @@
+import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from requests.exceptions import ConnectionError
+from rest_framework.exceptions import ParseError
+from rgwadmin.exceptions import NoSuchUser, ServerDown
+
+from buckets.models import BucketRegion
+from common.func import rgw_client
+from user.models import UsageDaily
+
+USAGE_FIELDS = ('get_ops', 'bytes_sent', 'put_ops', 'bytes_received')
+
+
+def parse_usage_entries(data: dict) -> dict:
+    """
+    按日期汇总rgw usage中的get_obj与put_obj，返回{日期: {get_ops, bytes_sent, put_ops, bytes_received}}
+    """
+    result = defaultdict(lambda: dict.fromkeys(USAGE_FIELDS, 0))
+    for entry in data.get('entries', []):
+        for bucket in entry['buckets']:
+            day = result[datetime.date.fromisoformat(bucket['time'][:10])]
+            for cate in bucket['categories']:
+                if cate.get('category', None) == 'get_obj':
+                    day['get_ops'] += cate['successful_ops']
+                    day['bytes_sent'] += cate['bytes_sent']
+                if cate.get('category', None) == 'put_obj':
+                    day['put_ops'] += cate['successful_ops']
+                    day['bytes_received'] += cate['bytes_received']
+    return result
+
+
+def to_json(v: dict) -> dict:
+    return UsageDaily(**v).json
+
+
+def fetch_region_usage(rgw, ceph_uid: str, start: datetime.date, end: datetime.date) -> dict:
+    """
+    查询一个区域中[start, end)的用量，在线程池中执行，不访问数据库
+    """
+    # uid为空时rgw返回所有用户的用量
+    if not ceph_uid:
+        return dict()
+    try:
+        data = rgw.get_usage(
+            uid=ceph_uid,
+            start=start.isoformat(),
+            end=end.isoformat(),
+            show_summary=False,
+            show_entries=True
+        )
+    except NoSuchUser:
+        return dict()
+    return parse_usage_entries(data)
+
+
+def query_daily_usage(u: User, start: datetime.date, end: datetime.date) -> dict:
+    """
+    查询用户每天的用量，返回{日期: UsageDaily.json格式的用量}
+
+    已经结束的日期从汇总表中读取，汇总表中没有的日期与当天的数据并发从各区域查询，
+    查询到的已结束日期写入汇总表，rgw usage按utc时间记录，以utc日期判断是否已经结束
+    """
+    today = datetime.datetime.utcnow().date()
+    days = [start + datetime.timedelta(days=n) for n in range((end - start).days + 1)]
+    result = {d: dict.fromkeys(USAGE_FIELDS, 0) for d in days}
+    # 还没有ceph账号的用户没有用量，不查询rgw也不写入汇总表
+    if not u.keys.ceph_uid:
+        return {d: to_json(v) for d, v in result.items()}
+
+    stored = defaultdict(set)
+    for row in UsageDaily.objects.filter(user=u, date__range=(start, end)):
+        stored[row.region_id].add(row.date)
+        for f in USAGE_FIELDS:
+            result[row.date][f] += getattr(row, f)
+
+    tasks = []
+    for region in BucketRegion.objects.filter(type='local'):
+        missing = [d for d in days if d < today and d not in stored[region.reg_id]]
+        if not missing and end < today:
+            continue
+        # rgw客户端在当前线程中获取，线程池中只有http请求
+        rgw = rgw_client(region.reg_id)
+        if rgw:
+            tasks.append((region, rgw, missing, missing[0] if missing else today))
+
+    if not tasks:
+        return {d: to_json(v) for d, v in result.items()}
+
+    new_rows = []
+    with ThreadPoolExecutor(max_workers=min(len(tasks), settings.USAGE_QUERY_WORKERS)) as executor:
+        futures = [
+            executor.submit(fetch_region_usage, rgw, u.keys.ceph_uid, fetch_start, end + datetime.timedelta(days=1))
+            for _, rgw, _, fetch_start in tasks
+        ]
+        for (region, _, missing, fetch_start), future in zip(tasks, futures):
+            try:
+                data = future.result()
+            except ConnectionError:
+                raise ParseError('connection to rgw server is timeout!')
+            except ServerDown:
+                raise ParseError('The backing server is not available.')
+
+            for d, v in data.items():
+                if fetch_start <= d <= end and (d in missing or d >= today):
+                    for f in USAGE_FIELDS:
+                        result[d][f] += v[f]
+            for d in missing:
+                new_rows.append(UsageDaily(user=u, region=region, date=d, **data.get(d, {})))
+
+    # 并发请求同时写入同一天的数据时忽略重复的记录
+    UsageDaily.objects.bulk_create(new_rows, batch_size=500, ignore_conflicts=True)
+    return {d: to_json(v) for d, v in result.items()}
@@ -8,14 +8,12 @@ from rest_framework.pagination import PageNumberPagination
 
 from django.contrib.auth.models import User, AnonymousUser
 from django.conf import settings
-from django.db.models import Q, Sum
+from django.db.models import Q, Sum, Count
 from django.contrib.auth import authenticate, login, logout
 from django.core.cache import cache
 
-from requests.exceptions import ConnectionError, ReadTimeout
-
 from buckets.models import BucketRegion, Buckets
-from common.tokenauth import verify_permission
+from common.tokenauth import verify_permission, build_token_record
 from common.verify import (
     verify_mail, verify_username,
     verify_phone, verify_length,
@@ -25,10 +23,13 @@ from common.verify import (
 from common.func import rgw_client, get_client_ip, validate_post_data
 from .serializer import UserSerialize, UserDetailSerialize
 from .models import Profile, DefaultGroup
-from rgwadmin.exceptions import NoSuchUser, ServerDown
+from rgwadmin.exceptions import NoSuchUser
 from .models import CapacityQuota
-from objects.models import Objects
+from .user_usage import query_daily_usage
+from objects.models import ObjectUsage
+from objects.objects_usage import get_usage, delete_user
 
+import datetime
 import random
 import time
 
@@ -300,7 +301,7 @@ def user_delete_endpoint(request):
                 continue
             else:
                 rgw.remove_user(uid=u.keys.ceph_uid, purge_data=True)
-    u.delete()
+    delete_user(u)
     return Response({
         'code': 0,
         'msg': 'success'
@@ -411,12 +412,12 @@ def get_user_detail_endpoint(request):
             u.profile.root_uid != request.user.username:
         raise NotAuthenticated()
 
-    user_used = Objects.objects.filter(owner=u).aggregate(Sum('file_size'))
+    user_used = get_usage('u', u.id)
 
     ser = UserDetailSerialize(u)
     ser_data = ser.data
     ser_data['bucket'] = [i['name'] for i in b]
-    ser_data['user_used'] = user_used['file_size__sum']
+    ser_data['user_used'] = user_used['file_size']
     # ser_data['objects'] = {
     #     'count': Objects.objects.filter(owner=request.user, type='f').count()
     # }
@@ -492,14 +493,14 @@ def query_cluster_usage_endpoint(request):
     data = []
     allocat_total = CapacityQuota.objects.aggregate(Sum('capacity'))
     used_total = 0
-    for i in BucketRegion.objects.all():
-        all_bucket = Buckets.objects.filter(bucket_region=i).values_list('bucket_id', flat=True)
-        object_sum = Objects.objects.filter(bucket__bucket_id__in=all_bucket).aggregate(Sum('file_size'))
-        object_sum = object_sum['file_size__sum'] if object_sum['file_size__sum'] else 0
+    # 从用量记录中读取各区域的容量，不统计文件对象表
+    region_usage = dict(ObjectUsage.objects.filter(scope='r').values_list('scope_id', 'file_size'))
+    for i in BucketRegion.objects.annotate(bucket_total=Count('buckets')):
+        object_sum = region_usage.get(i.reg_id, 0)
 
         data.append({
             'region_name': i.name,
-            'bucket_total': len(all_bucket),
+            'bucket_total': i.bucket_total,
             'file_size_total': round(object_sum/1024**3, 2)
         })
         used_total += object_sum
@@ -552,96 +553,16 @@ def query_user_usage(request):
         raise ParseError('start time to end time more than 31 days')
 
     usage_data = []
-    reg = BucketRegion.objects.all()
-
-    def __build_fake_data(__start_time_ts, __end_time_ts):
-        temp = {}
-        while 1:
-            dt = time.strftime(fmt, time.localtime(__start_time_ts))
-            if dt not in temp:
-                temp[dt] = {
-                    'get_obj': {
-                        'successful_ops': 0,
-                        'bytes_sent':  0,
-                    },
-                    'put_obj': {
-                        'successful_ops':  0,
-                        'bytes_received':  0,
-                    },
-                }
-            __start_time_ts += 86400
-            if __start_time_ts > __end_time_ts:
-                break
-        return temp
-
-    def __update_fake_date(__fake_data, origin_data):
-        if len(origin_data['entries']) == 0:
-            return
-        # buff = {}
-        for bucket in origin_data['entries'][0]['buckets']:
-            act_time = bucket['time'][:10]
-            print(act_time)
-            print(bucket)
-            for cate in bucket['categories']:
-                print(cate)
-                if 'category' in cate and cate['category'] == 'put_obj':
-                    __fake_data[act_time]['put_obj']['successful_ops'] += cate['successful_ops']
-                    __fake_data[act_time]['put_obj']['bytes_received'] += cate['bytes_received']
-                if 'category' in cate and cate['category'] == 'get_obj':
-                    __fake_data[act_time]['get_obj']['successful_ops'] += cate['successful_ops']
-                    __fake_data[act_time]['get_obj']['bytes_sent'] += cate['bytes_sent']
-
-    fake_data = __build_fake_data(start_time_ts, end_time_ts)
-
-    for i in reg:
-        if i.type != 'local':
-            continue
-        rgw = rgw_client(i.reg_id)
-        try:
-            rgw.get_user(uid=req_user.keys.ceph_uid, stats=True)
-        except NoSuchUser:
-            continue
-        except ConnectionError:
-            raise ParseError('connection to rgw server is timeout!')
-        except ServerDown:
-            raise ParseError('The backing server is not available.')
-
-        s_date = time.strftime(fmt, time.localtime(start_time_ts))
-        e_date = time.strftime(fmt, time.localtime(end_time_ts))
-
-        if s_date[5:7] == e_date[5:7]:
-            # 未跨月
-            data = rgw.get_usage(
-                uid=u.keys.ceph_uid,
-                start=s_date,
-                end=e_date,
-                show_summary=False,
-                show_entries=True
-            )
-            __update_fake_date(fake_data, data)
-        else:
-            # 跨月
-            data = rgw.get_usage(
-                uid=u.keys.ceph_uid,
-                start=s_date,
-                end=s_date[:8] + '31',
-                show_summary=False,
-                show_entries=True
-            )
-            __update_fake_date(fake_data, data)
-
-            data = rgw.get_usage(
-                uid=u.keys.ceph_uid,
-                start=e_date[:8] + '01',
-                end=e_date,
-                show_summary=False,
-                show_entries=True
-            )
-            __update_fake_date(fake_data, data)
+    # 已经结束的日期从汇总表读取，只有汇总表中没有的日期与当天的数据从rgw查询
+    daily_usage = query_daily_usage(
+        u,
+        datetime.date.fromtimestamp(start_time_ts),
+        datetime.date.fromtimestamp(end_time_ts)
+    )
 
-    for k, v in fake_data.items():
+    for k, v in daily_usage.items():
         usage_data.append({
-            'date': k,
+            'date': k.strftime(fmt),
             'usage': v
         })
 
@@ -679,8 +600,8 @@ def cache_request_user_meta_info(token_key, request):
     """
     ua = request.META.get('HTTP_USER_AGENT', 'unknown')
     remote_ip = get_client_ip(request)
-    user = Token.objects.get(key=token_key).user
+    user = Token.objects.select_related('user__capacity_quota').get(key=token_key).user
 
     # write token extra info to cache
-    cache.set('token_%s' % token_key, (ua, remote_ip, time.time(), user), 3600)
+    cache.set('token_%s' % token_key, build_token_record(user, ua, remote_ip), 3600)
     # print(cache.get('token_%s' % token_key))